@@ -4,22 +4,24 @@
 # Copyright (c) 2020 by Harald Klein <hari@vt100.at> - All rights reserved
 # 
 
-import sys
 import time
+STARTUP_TIME = time.monotonic()
+
+import sys
 import logging
-import logging.handlers
-import traceback
 import os
 import argparse
 import threading
-import importlib
+import concurrent.futures
 
-import chess.pgn
 import chess
 
-import berserk
 import certabo
 from certabo.certabo import CERTABO_DATA_PATH as CERTABO_DATA_PATH
+from certabo import logpipeline
+from certabo import journal
+from certabo import config
+from certabo import clock
 
 parser = argparse.ArgumentParser()
 parser.add_argument("--port")
@@ -30,15 +32,36 @@ parser.add_argument("--correspondence", action="store_true")
 parser.add_argument("--devmode", action="store_true")
 parser.add_argument("--quiet", action="store_true")
 parser.add_argument("--debug", action="store_true")
+parser.add_argument("--loglevel", action="append", metavar="LOGGER=LEVEL")
+parser.add_argument("--synclog", action="store_true")
+parser.add_argument("--journal", action="store_true")
+parser.add_argument("--archive", action="store_true")
+parser.add_argument("--export-pgn", metavar="OUTPUT")
+parser.add_argument("--mirror", metavar="SOURCE")
+parser.add_argument("--mirror-port", action="append", metavar="PORT")
+parser.add_argument("--mirror-delay", type=float, default=2.0)
+parser.add_argument("--config")
+parser.add_argument("--profile")
 args = parser.parse_args()
 
-portname = 'auto'
+# command line arguments take precedence over the config file
+overrides = {}
 if args.port is not None:
-    portname = args.port
-
-TOKEN_FILE='./lichess.token'
+    overrides['port'] = args.port
 if args.tokenfile is not None:
-    TOKEN_FILE = args.tokenfile
+    overrides['tokenfile'] = args.tokenfile
+if args.correspondence:
+    overrides['correspondence'] = True
+if args.debug:
+    overrides['debug'] = True
+
+try:
+    settings, profile = config.load_settings(args.config, args.profile, overrides)
+except (config.ConfigError, OSError, ValueError) as e:
+    print(f'ERROR: invalid configuration: {e}')
+    sys.exit(-1)
+
+TOKEN_FILE = settings.tokenfile
 
 calibrate = 0 # don't do calibration by default
 if args.calibrate:
@@ -47,28 +70,19 @@ if args.calibrate:
 if args.addpiece:
     calibrate = 1 # add further pieces to existing calibration
 
-correspondence = False
-if args.correspondence:
-    correspondence = True
-
-DEBUG=False
-if args.debug:
-    DEBUG = True
+try:
+    loglevels = logpipeline.parse_levels(args.loglevel)
+except ValueError as e:
+    print(f'ERROR: {e}')
+    sys.exit(-1)
 
 logger = logging.getLogger()
-logger.setLevel(logging.DEBUG)
-formatter = logging.Formatter('%(asctime)s %(levelname)s %(module)s %(message)s')
-
-filehandler = logging.handlers.TimedRotatingFileHandler(
-    os.path.join(CERTABO_DATA_PATH, "certabo-lichess.log"), backupCount=12
+loglistener = logpipeline.setup_logging(
+    os.path.join(CERTABO_DATA_PATH, "certabo-lichess.log"),
+    console=not args.quiet,
+    levels=loglevels,
+    asynchronous=not args.synclog,
 )
-filehandler.setFormatter(formatter)
-logger.addHandler(filehandler)
-
-if not args.quiet:
-    consoleHandler = logging.StreamHandler()
-    consoleHandler.setFormatter(formatter)
-    logger.addHandler(consoleHandler)
 
 # log unhandled exceptions to the log file
 def my_excepthook(excType, excValue, traceback, logger=logger):
@@ -77,62 +91,171 @@ def my_excepthook(excType, excValue, traceback, logger=logger):
 sys.excepthook = my_excepthook
 
 logging.info("certabo-lichess.py startup")
+logging.info('using profile %s: %s', profile, settings)
 
 class Game(threading.Thread):
-    def __init__(self, client, mycertabo, game_id, **kwargs):
+    def __init__(self, client, mycertabo, game_id, journal=None, archive_dir=None, **kwargs):
         super().__init__(**kwargs)
         self.game_id = game_id
         self.certabo = mycertabo
         self.client = client
+        self.journal = journal
+        self.archive_dir = archive_dir
+        self.archive = None
+        self.last_state = None
+        # sends our moves, so the stream loop never blocks on the board or the network
+        self.mover = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix=f'move-{game_id}')
+        self.clock = clock.ClockPolicy(mycertabo.base_settings)
         self.stream = client.board.stream_game_state(game_id)
         self.current_state = next(self.stream)
+        if self.journal is not None:
+            self.journal.record_event(self.current_state, self.game_id)
 
     def run(self):
-        for event in self.stream:
-            if event['type'] == 'gameState':
-                self.handle_state_change(event)
-            elif event['type'] == 'chatLine':
-                self.handle_chat_line(event)
+        try:
+            for event in self.stream:
+                if event['type'] == 'gameState':
+                    self.handle_state_change(event)
+                elif event['type'] == 'chatLine':
+                    self.handle_chat_line(event)
+                # journaled after handling, a premove is sent before any bookkeeping
+                if self.journal is not None:
+                    self.journal.record_event(event, self.game_id)
+                if event['type'] == 'gameState' and event.get('status', 'started') != 'started':
+                    logging.info('game %s ended: %s', self.game_id, event.get('status'))
+                    break
+        finally:
+            self.finish()
+
+    def finish(self):
+        # nothing of this game may outlive it
+        self.certabo.cancel_move_request(self.game_id)
+        self.certabo.set_speed_mode(clock.NORMAL)
+        self.mover.shutdown(wait=False)
+        if self.archive is not None:
+            self.archive.finish(self.last_state)
+        logging.info('move latency per mode (count, avg, max): %s', self.clock.summary())
+
+    def request_user_move(self):
+        future = self.certabo.request_move(self.game_id)
+        future.add_done_callback(self.user_move_done)
+
+    def user_move_done(self, future):
+        # runs on the serial thread that detected the move, hand over to our mover
+        if future.cancelled():
+            return
+        try:
+            self.mover.submit(self.send_move, future.result())
+        except RuntimeError:
+            logging.debug('game %s is over, dropping move', self.game_id)
+
+    def send_move(self, moves):
+        # only the POST is retried, returns True once lichess accepted the move
+        sent = False
+        for attempt in range(self.certabo.settings.move_retries):
+            try:
+                self.client.board.make_move(self.game_id, moves[0])
+                sent = True
+                break
+            except:
+                e = sys.exc_info()[0]
+                logging.info('exception on make_move: %s', e)
+            if attempt > 1:
+                logging.debug('sleeping before retry')
+                time.sleep(self.certabo.settings.move_retry_delay)
+        if not sent:
+            return False
+        detected_at = self.certabo.move_detected_at
+        if detected_at is not None:
+            self.clock.record_latency(time.monotonic() - detected_at)
+        logging.info('our move: %s', moves)
+        self.certabo.move_confirmed(moves[0])
+        return True
 
     def handle_state_change(self, game_state):
         # {'type': 'gameState', 'moves': 'd2d3 e7e6 b1c3', 'wtime': datetime.datetime(1970, 1, 25, 20, 31, 23, 647000, tzinfo=datetime.timezone.utc), 'btime': datetime.datetime(1970, 1, 25, 20, 31, 23, 647000, tzinfo=datetime.timezone.utc), 'winc': datetime.datetime(1970, 1, 1, 0, 0, tzinfo=datetime.timezone.utc), 'binc': datetime.datetime(1970, 1, 1, 0, 0, tzinfo=datetime.timezone.utc), 'bdraw': False, 'wdraw': False}
 
-        print(game_state)
-        tmp_chessboard = chess.Board()
-        moves = game_state['moves'].split(' ')
-        for move in moves:
-            tmp_chessboard.push_uci(move)
-            # print(move)
-            self.certabo.set_board_from_fen(tmp_chessboard.fen())
-        if tmp_chessboard.turn == self.certabo.get_color():
-            logging.info('it is our turn')
-            moves = self.certabo.get_user_move()
-            logging.info(f'our move: {moves}')
-            for attempt in range(3):
-                try:
-                    self.client.board.make_move(self.certabo.get_reference(), moves[0])
-                    break
-                except:
-                    e = sys.exc_info()[0]
-                    logging.info(f'exception on make_move: {e}')
-                if attempt > 1:
-                    logging.debug(f'sleeping before retry')
-                    time.sleep(3)
+        # pick the speed mode first, a low clock shouldn't wait for the bookkeeping below
+        self.clock.settings = self.certabo.base_settings
+        mode, changed = self.clock.update(game_state, self.certabo.get_color())
+        if changed:
+            self.certabo.set_speed_mode(mode)
+
+        # only the new plies are replayed, the resync engine keeps the recent positions
+        self.certabo.set_game_moves(game_state['moves'].split(' '))
+        if game_state.get('status', 'started') != 'started':
+            self.certabo.cancel_move_request(self.game_id)
+        elif self.certabo.chessboard.turn == self.certabo.get_color():
+            premove = self.certabo.take_premove()
+            # already made on the board during the opponent's turn, send it right away
+            if premove is None or not self.send_move([premove]):
+                if premove is not None:
+                    logging.info('premove %s was not accepted, waiting for a move on the board', premove)
+                logging.info('it is our turn')
+                self.request_user_move()
+        else:
+            # e.g. after a takeback, a pending request is stale
+            self.certabo.cancel_move_request(self.game_id)
+
+        # bookkeeping only once our move is on its way
+        logging.debug('game state: %s', game_state)
+        self.last_state = game_state
+        if self.archive_dir is not None:
+            if self.archive is None:
+                # chess.pgn is slow to import, only load it when archiving
+                from certabo import archive
+                # created on the first state, our color is only known after the game setup
+                self.archive = archive.PGNWriter(self.archive_dir, self.game_id, self.current_state,
+                                                 self.certabo.get_color())
+            self.archive.update(game_state)
 
 
     def handle_chat_line(self, chat_line):
-        print(chat_line)
+        logging.debug('chat line: %s', chat_line)
         pass
 
 
+# closed on shutdown, so the end of the session isn't lost with the daemon thread
+sessionjournal = None
+mycertabo = None
+
+
 def main():
+    global sessionjournal, mycertabo
+    import importlib.util
     simplejson_spec = importlib.util.find_spec("simplejson")
     if simplejson_spec is not None:
         print(f'ERROR: simplejson is installed. The berserk lichess client will not work with simplejson. Please remove the module. Aborting.')
         sys.exit(-1)
 
-    mycertabo = certabo.certabo.Certabo(port=portname, calibrate=calibrate)
+    if args.export_pgn is not None:
+        # offline, needs neither the board nor lichess
+        from certabo import archive
+        journaldir = os.path.join(CERTABO_DATA_PATH, "journal")
+        try:
+            count = archive.export_journals(journal.journal_files(journaldir), args.export_pgn)
+        except (OSError, ValueError) as e:
+            print(f'ERROR: cannot export games: {e}')
+            sys.exit(-1)
+        print(f'exported {count} games to {args.export_pgn}')
+        sys.exit(0)
+
+    if args.mirror is not None:
+        # spectator mode, the public lichess streams need no token
+        from certabo import mirror
+        wall = mirror.Mirror(args.mirror_port or [settings.port], settings.baudrate,
+                             settings.orientation == 'rotated')
+        if not wall.wait_ready(timeout=10):
+            logging.info('not all boards connected yet, continuing in the background')
+        base_url = "https://lichess.dev" if args.devmode else mirror.LICHESS_URL
+        try:
+            wall.run(mirror.positions(args.mirror, args.mirror_delay, base_url))
+        except OSError as e:
+            print(f'ERROR: cannot mirror {args.mirror}: {e}')
+            sys.exit(-1)
+        sys.exit(0)
 
+    # validate everything we can before touching the hardware, the serial handshake takes ~2s
     try:
         logging.info(f'reading token from {TOKEN_FILE}')
         with open(TOKEN_FILE) as f:
@@ -143,6 +266,26 @@ def main():
     except PermissionError:
         print(f'ERROR: permission denied on token file')
         sys.exit(-1)
+    if not token:
+        print(f'ERROR: token file {TOKEN_FILE} is empty')
+        sys.exit(-1)
+    token_time = time.monotonic()
+
+    archivedir = os.path.join(CERTABO_DATA_PATH, "archive") if args.archive else None
+    if args.journal:
+        sessionjournal = journal.JournalWriter(os.path.join(CERTABO_DATA_PATH, "journal"))
+        sessionjournal.start()
+
+    # the serial thread does the board handshake in the background while we set up the lichess session
+    mycertabo = certabo.certabo.Certabo(calibrate=calibrate, journal=sessionjournal, settings=settings)
+
+    # SIGHUP reloads the config file, tuning values apply without restarting the serial link
+    reloader = config.ConfigReloader(args.config, args.profile, settings, mycertabo.apply_settings, overrides)
+    if args.config is not None:
+        reloader.install()
+
+    # berserk pulls in requests and friends, only load it once we know we need it
+    import berserk
 
     try:
         session = berserk.TokenSession(token)
@@ -162,6 +305,14 @@ def main():
         logging.info(f'cannot create lichess client: {e}')
         print(f"cannot create lichess client: {e}")
         sys.exit(-1)
+    client_time = time.monotonic()
+
+    if not mycertabo.wait_ready(timeout=10):
+        logging.info('board not connected yet, continuing in the background')
+    ready_time = time.monotonic()
+    logging.info('startup took %.3fs (config %.3fs, lichess client %.3fs, waiting for board %.3fs)',
+                 ready_time - STARTUP_TIME, token_time - STARTUP_TIME,
+                 client_time - token_time, ready_time - client_time)
 
     def is_correspondence(gameId):
         try:
@@ -212,13 +363,13 @@ def main():
                     logging.info(f"game start received: {game_data['id']}")
 
                     # check if game speed is correspondence, skip those if --correspondence argument is not set
-                    if not correspondence:
+                    if not reloader.settings.correspondence:
                         if is_correspondence(game_data['id']):
                             logging.info(f"skipping corespondence game: {game_data['id']}")
                             continue
 
                     try:
-                        game = Game(client, mycertabo, game_data['id'])
+                        game = Game(client, mycertabo, game_data['id'], journal=sessionjournal, archive_dir=archivedir)
                         game.daemon = True
                         game.start()
                     except berserk.exceptions.ResponseError as e:
@@ -231,8 +382,11 @@ def main():
                     if mycertabo.get_state() == 'myturn':
                         logging.info(f'starting new game, checking for user move')
                         mycertabo.set_state('init')
-                        moves = mycertabo.get_user_move()
-                        client.board.make_move(mycertabo.get_reference(), moves[0])
+                        game.request_user_move()
+                elif event['type'] == 'gameFinish':
+                    game_data = event['game']
+                    logging.info(f"game finish received: {game_data['id']}")
+                    mycertabo.cancel_move_request(game_data['id'])
 
         except berserk.exceptions.ResponseError as e:
             print(f'ERROR: Invalid server response: {e}')
@@ -241,5 +395,13 @@ def main():
                 time.sleep(10)
 
 if __name__ == '__main__':
-    main()
+    try:
+        main()
+    finally:
+        if mycertabo is not None:
+            mycertabo.shutdown()
+        if sessionjournal is not None:
+            sessionjournal.close()
+        if loglistener is not None:
+            loglistener.stop()
 
@@ -0,0 +1,222 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2020 by Harald Klein <hari@vt100.at> - All rights reserved
+#
+
+import os
+import bz2
+import gzip
+import lzma
+import time
+import logging
+
+import chess
+import chess.pgn
+
+from certabo import journal
+from certabo.clock import clock_seconds
+
+logger = logging.getLogger(__name__)
+
+RESULTS = {'white': '1-0', 'black': '0-1'}
+DRAWN = ('draw', 'stalemate')
+
+
+def game_result(game_state):
+    """ PGN result for a gameState, '*' while the game is running """
+    winner = game_state.get('winner')
+    if winner in RESULTS:
+        return RESULTS[winner]
+    if game_state.get('status') in DRAWN:
+        return '1/2-1/2'
+    return '*'
+
+
+def player_name(player):
+    if not isinstance(player, dict):
+        return '?'
+    if player.get('aiLevel'):
+        return f"lichess AI level {player['aiLevel']}"
+    return player.get('name') or player.get('id') or '?'
+
+
+def game_headers(game_id, game_full=None, color=None):
+    """ chess.pgn.Headers for a lichess game, game_full is the first event of the game stream """
+    headers = chess.pgn.Headers()
+    headers['Event'] = 'lichess board API game'
+    headers['Site'] = f'https://lichess.org/{game_id}'
+    headers['Date'] = time.strftime('%Y.%m.%d')
+    game_full = game_full or {}
+    headers['White'] = player_name(game_full.get('white'))
+    headers['Black'] = player_name(game_full.get('black'))
+    clock = game_full.get('clock')
+    if isinstance(clock, dict) and 'initial' in clock:
+        initial = clock_seconds(clock['initial'])
+        increment = clock_seconds(clock.get('increment', 0))
+        headers['TimeControl'] = f'{int(initial)}+{int(increment)}'
+    headers['GameId'] = game_id
+    if color is not None:
+        headers['BoardColor'] = chess.COLOR_NAMES[color]
+    return headers
+
+
+def format_headers(headers):
+    lines = []
+    for key, value in headers.items():
+        value = value.replace('\\', '\\\\').replace('"', '\\"')
+        lines.append(f'[{key} "{value}"]\n')
+    return ''.join(lines) + '\n'
+
+
+def format_clock(seconds):
+    seconds = max(0, int(seconds))
+    return f'{{ [%clk {seconds // 3600}:{seconds // 60 % 60:02d}:{seconds % 60:02d}] }}'
+
+
+class MoveText():
+    """ builds the movetext of one game move by move """
+
+    def __init__(self):
+        self.board = chess.Board()
+        self.moves = []
+
+    def new_moves(self, moves, game_state=None):
+        """
+        Movetext for the moves not seen yet, moves is the full uci list of the
+        game. The last move gets the mover's clock from game_state if present.
+        Returns None if moves doesn't continue the moves seen so far (takeback).
+        """
+        moves = [move for move in moves if move]
+        if moves[:len(self.moves)] != self.moves:
+            return None
+        text = []
+        new = moves[len(self.moves):]
+        for i, uci in enumerate(new):
+            move = chess.Move.from_uci(uci)
+            if self.board.turn == chess.WHITE:
+                text.append(f'{self.board.fullmove_number}.')
+            elif i == 0:
+                text.append(f'{self.board.fullmove_number}...')
+            text.append(self.board.san(move))
+            if i == len(new) - 1 and game_state is not None:
+                field = 'wtime' if self.board.turn == chess.WHITE else 'btime'
+                seconds = clock_seconds(game_state.get(field))
+                if seconds is not None:
+                    text.append(format_clock(seconds))
+            self.board.push(move)
+            self.moves.append(uci)
+        return ' '.join(text)
+
+
+class PGNWriter():
+    """
+    Writes one game to <game id>.pgn as it is played. Until the game ends it
+    lives in <game id>.pgn.part, written and flushed on every gameState, so an
+    interrupted game still leaves a readable PGN with result "*". finish()
+    writes the final file with a Result tag that matches the termination
+    marker and removes the part file.
+    """
+
+    def __init__(self, directory, game_id, game_full=None, color=None):
+        os.makedirs(directory, exist_ok=True)
+        self.filename = os.path.join(directory, f'{game_id}.pgn')
+        self.partname = self.filename + '.part'
+        self.headers = game_headers(game_id, game_full, color)
+        self.finished = False
+        self.file = None
+        self.start()
+        logger.info('archiving game %s to %s', game_id, self.filename)
+
+    def start(self):
+        if self.file is not None:
+            self.file.close()
+        self.movetext = MoveText()
+        self.text = []
+        self.file = open(self.partname, 'w')
+        self.write(format_headers(self.headers))
+
+    def write(self, text):
+        self.file.write(text)
+        self.file.flush()
+
+    def update(self, game_state):
+        moves = game_state.get('moves', '').split(' ')
+        text = self.movetext.new_moves(moves, game_state)
+        if text is None:
+            # takeback: rewrite the part file from the new move list
+            logger.info('move list of %s changed, rewriting the archived game', self.headers['GameId'])
+            self.start()
+            text = self.movetext.new_moves(moves, game_state)
+        if text:
+            self.text.append(text)
+            self.write(text + ' ')
+
+    def finish(self, game_state=None):
+        if self.finished:
+            return
+        self.finished = True
+        self.file.close()
+        result = game_result(game_state) if game_state is not None else '*'
+        self.headers['Result'] = result
+        tmpname = self.filename + '.tmp'
+        with open(tmpname, 'w') as f:
+            f.write(format_headers(self.headers))
+            f.write(' '.join(self.text + [result]) + '\n\n')
+        os.replace(tmpname, self.filename)
+        os.remove(self.partname)
+
+
+def open_output(filename):
+    """ text file for writing, compressed according to the extension """
+    if filename.endswith('.gz'):
+        return gzip.open(filename, 'wt')
+    if filename.endswith('.bz2'):
+        return bz2.open(filename, 'wt')
+    if filename.endswith('.xz'):
+        return lzma.open(filename, 'wt')
+    return open(filename, 'w')
+
+
+def export_journals(filenames, output):
+    """
+    Convert the lichess events of session journals into one multi-game PGN.
+
+    Journals are read lazily and each game is written as soon as it ends, so
+    memory use only depends on the number of games running at the same time.
+    Returns the number of games written.
+    """
+    running = {}  # game id -> [headers, last gameState]
+    count = 0
+
+    def write_game(out, headers, game_state):
+        movetext = MoveText()
+        moves = movetext.new_moves(game_state.get('moves', '').split(' ')) if game_state else ''
+        result = game_result(game_state) if game_state else '*'
+        headers['Result'] = result
+        out.write(format_headers(headers))
+        out.write(f'{moves} {result}\n\n' if moves else f'{result}\n\n')
+
+    with open_output(output) as out:
+        for filename in filenames:
+            for record in journal.read_journal(filename):
+                if record.kind != journal.EVENT:
+                    continue
+                event = record.data
+                game_id = event.get('gameId') or event.get('id')
+                if game_id is None:
+                    continue
+                if event.get('type') == 'gameFull':
+                    headers = game_headers(game_id, event)
+                    headers['Date'] = time.strftime('%Y.%m.%d', time.localtime(record.timestamp))
+                    running[game_id] = [headers, event.get('state')]
+                elif event.get('type') == 'gameState' and game_id in running:
+                    running[game_id][1] = event
+                    if event.get('status', 'started') != 'started':
+                        write_game(out, *running.pop(game_id))
+                        count += 1
+        for headers, game_state in running.values():
+            write_game(out, headers, game_state)
+            count += 1
+    logger.info('exported %d games to %s', count, output)
+    return count
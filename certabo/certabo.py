@@ -7,31 +7,62 @@
 import os
 import time
 import logging
-import logging.handlers
-import traceback
-import argparse
-import subprocess
-import threading
+import concurrent.futures
 import appdirs
-import pathlib
 
-import berserk
-
-import chess.pgn
 import chess
 
 # certabo helpers
 from certabo import codes
 from certabo import serialreader
+from certabo import offload
+from certabo import resync
+from certabo import poscache
+from certabo import learner
+from certabo import clock
+from certabo.config import Settings
 
 CERTABO_DATA_PATH = appdirs.user_data_dir("GUI", "Certabo")
 CALIBRATION_DATA = os.path.join(CERTABO_DATA_PATH,"calibration.bin")
+LEARNED_DATA = os.path.join(CERTABO_DATA_PATH,"calibration-learned.bin")
 os.makedirs(CERTABO_DATA_PATH, exist_ok=True)
 
+logger = logging.getLogger(__name__)
+
+def suppress_logging(name, level):
+    """
+    Raise the logger name and its children that have their own level (e.g.
+    from --loglevel) to at least level. Returns the old levels for
+    restore_logging().
+    """
+    names = [name] + [child for child, child_logger in logging.root.manager.loggerDict.items()
+                      if child.startswith(name + '.') and isinstance(child_logger, logging.Logger)
+                      and child_logger.level != logging.NOTSET]
+    saved = {}
+    for logger_name in names:
+        suppressed = logging.getLogger(logger_name)
+        saved[logger_name] = suppressed.level
+        if suppressed.level < level:
+            suppressed.setLevel(level)
+    return saved
+
+
+def restore_logging(saved):
+    for logger_name, level in saved.items():
+        logging.getLogger(logger_name).setLevel(level)
+
+
 class Certabo():
-    def __init__(self, port='auto', calibrate=0, **kwargs):
+    def __init__(self, port='auto', calibrate=0, journal=None, settings=None, **kwargs):
         super().__init__(**kwargs)
-        self.portname = port
+        if settings is None:
+            settings = Settings(port=port)
+        self.base_settings = settings
+        self.settings = settings
+        self.speed_mode = clock.NORMAL
+        self.saved_log_levels = None
+        self.portname = settings.port
+        self.journal = journal
         if calibrate:
             self.calibration = True
         else:
@@ -40,43 +71,173 @@ class Certabo():
             self.new_setup = True
         else:
             self.new_setup = False
-        self.rotate180 = False
+        # orientation of the board as a square permutation, see codes.CELL_SQUARES
+        self.rotate180 = settings.orientation == 'rotated'
         self.color = chess.WHITE
         self.starting_position = chess.STARTING_FEN
         self.chessboard = chess.Board(chess.STARTING_FEN)
+        self.resync = resync.Resync(settings.resync_depth)
         self.board_state_usb = ""
+        self.usb_unknown = 0
         self.mystate = "init"
         self.reference = ""
-        self.move_event = threading.Event()
-        self.wait_for_move = False
+        self.move_future = None
+        self.move_reference = None
+        self.move_detected_at = None
+        self.premove = None
         self.pending_moves = []
+        self.last_leds = None
+        self.last_leds_time = 0
 
         # internal values for CERTABO board
         self.calibration_samples_counter = 0
         self.calibration_samples = []
-        self.usb_data_history_depth = 3
-        self.usb_data_history = list(range(self.usb_data_history_depth))
-        self.usb_data_history_filled = False
-        self.usb_data_history_i = 0
+        self.calibration_job = None
+        self.offloader = offload.Offloader(settings.worker_processes)
+        self.reset_history()
         self.move_detect_tries = 0
         self.move_detect_max_tries = 3
 
-        # try to load calibration data (mapping of RFID chip IDs to pieces)
-        codes.load_calibration(CALIBRATION_DATA)
+        # try to load calibration data (mapping of RFID chip IDs to pieces). This is an
+        # immutable codes.Calibration, updates replace the whole object.
+        self.calibration_data = codes.Calibration.load(CALIBRATION_DATA)
+        self.learner = None
+        if settings.online_learning:
+            self.learner = learner.Learner(self.calibration_data, LEARNED_DATA, settings.learned_codes_max)
+            self.calibration_data = self.learner.calibration()
+        self.move_frame = None
 
         # spawn a serial thread and pass our data handler
-        self.serialthread = serialreader.serialreader(self.handle_usb_data, self.portname)
+        self.serialthread = serialreader.serialreader(self.handle_usb_data, self.portname, settings.baudrate,
+                                                      settings.stall_timeout, self.board_stalled,
+                                                      settings.link_stats_interval)
         self.serialthread.daemon = True
         self.serialthread.start()
 
-    def get_user_move(self):
-        self.wait_for_move = True
-        logging.debug('waiting for event signal')
-        self.move_event.wait()
-        self.move_event.clear()
-        logging.debug(f'event signal received, pending moves: {self.pending_moves}')
-        self.wait_for_move = False
-        return self.pending_moves 
+    def reset_history(self):
+        self.usb_data_history_depth = self.settings.history_depth
+        self.usb_data_history = list(range(self.usb_data_history_depth))
+        self.usb_data_history_filled = False
+        self.usb_data_history_i = 0
+
+    def apply_settings(self, settings):
+        # called on config reload. The serial thread picks up a new history depth
+        # on its next frame, so the link itself keeps running.
+        self.base_settings = settings
+        self.settings = clock.mode_settings(settings, self.speed_mode)
+        self.resync.depth = settings.resync_depth
+        self.apply_learning(settings)
+        if settings.orientation != 'auto':
+            self.set_rotate180(settings.orientation == 'rotated')
+        self.serialthread.set_stats_interval(settings.link_stats_interval)
+
+    def apply_learning(self, settings):
+        # switch online learning on or off and apply a new limit without a restart
+        if settings.online_learning and self.learner is None:
+            self.learner = learner.Learner(self.calibration_data, LEARNED_DATA, settings.learned_codes_max)
+            self.calibration_data = self.learner.calibration()
+        elif not settings.online_learning and self.learner is not None:
+            # learned codes stay in their file, they are just not used
+            self.calibration_data = self.learner.base
+            self.learner = None
+        elif self.learner is not None and self.learner.set_max_codes(settings.learned_codes_max):
+            self.calibration_data = self.learner.calibration()
+
+    def set_rotate180(self, rotate180):
+        if rotate180 == self.rotate180:
+            return
+        logger.info('board orientation: %s', 'black on the connector side' if rotate180 else 'white on the connector side')
+        self.rotate180 = rotate180
+        # the frame history holds raw cells and stays valid, only the decoded position is stale
+        self.board_state_usb = ""
+
+    def detect_orientation(self, result):
+        """
+        Switch the orientation if the board shows the starting position turned
+        by 180 degrees. Returns True if it was switched, the frame then has to
+        be decoded again.
+        """
+        # runs on every frame, a list compare usually stops at the first square
+        if self.settings.orientation != 'auto' or result.pieces != codes.ROTATED_START_PIECES:
+            return False
+        self.set_rotate180(not self.rotate180)
+        return True
+
+    def set_speed_mode(self, mode):
+        """
+        Switch between the clock.MODES. Faster modes debounce over fewer frames,
+        and in a scramble LEDs are switched off and info and debug logging of
+        our loggers is suppressed (not deferred, those records are lost), so the
+        serial thread does as little as possible.
+        """
+        if mode == self.speed_mode:
+            return
+        logger.info('board speed mode %s -> %s', self.speed_mode, mode)
+        self.speed_mode = mode
+        self.settings = clock.mode_settings(self.base_settings, mode)
+        if mode == clock.SCRAMBLE:
+            self.send_leds()
+            if self.saved_log_levels is None:
+                self.saved_log_levels = suppress_logging('certabo', logging.WARNING)
+        elif self.saved_log_levels is not None:
+            restore_logging(self.saved_log_levels)
+            self.saved_log_levels = None
+
+    def wait_ready(self, timeout=None):
+        # True once the serial handshake with the board has completed
+        return self.serialthread.ready.wait(timeout)
+
+    def board_stalled(self, stalled):
+        # called from the serial thread when the board stops or resumes sending
+        if stalled:
+            # frames from before the gap must not be debounced together with new ones
+            self.reset_history()
+        if self.journal is not None:
+            self.journal.record_event({'type': 'boardStall', 'stalled': stalled})
+
+    @property
+    def wait_for_move(self):
+        future = self.move_future
+        return future is not None and not future.done()
+
+    def request_move(self, reference=None):
+        """
+        Start looking for a move on the board. Returns a concurrent.futures.Future
+        that resolves to the list of detected uci moves. A previous request is
+        cancelled, reference (the game id) scopes cancel_move_request().
+        """
+        future = concurrent.futures.Future()
+        previous = self.move_future
+        self.move_reference = reference
+        self.move_future = future
+        if previous is not None:
+            previous.cancel()
+        logger.debug('waiting for user move (%s)', reference)
+        return future
+
+    def cancel_move_request(self, reference=None):
+        """ cancel the pending request, if reference is given only if it belongs to it """
+        future = self.move_future
+        if future is None or (reference is not None and reference != self.move_reference):
+            return False
+        self.move_future = None
+        logger.debug('move request cancelled (%s)', self.move_reference)
+        return future.cancel()
+
+    def get_user_move(self, timeout=None):
+        """
+        Blocking variant of request_move(). Raises concurrent.futures.TimeoutError
+        or concurrent.futures.CancelledError if no move arrives.
+        """
+        future = self.request_move(self.reference)
+        try:
+            moves = future.result(timeout)
+        except concurrent.futures.TimeoutError:
+            if self.move_future is future:
+                self.cancel_move_request()
+            raise
+        logger.debug('user move received: %s', moves)
+        return moves
 
     def get_reference(self):
         return self.reference
@@ -98,74 +259,241 @@ class Certabo():
 
     def new_game(self):
         self.chessboard = chess.Board()
+        self.resync.reset()
         self.mystate = "init"
+        logger.debug('position cache stats (hits, misses, size): %s', poscache.stats())
 
     def set_board_from_fen(self, fen):
         self.chessboard = chess.Board(fen)
 
+    def set_game_moves(self, moves):
+        # full uci move list from the lichess game state
+        self.resync.update(moves)
+        self.set_board_from_fen(self.resync.board.fen())
+
+    def get_move_masks(self, board=None):
+        # origin square -> legal destinations bitmask, memoized per position
+        if board is None:
+            board = self.chessboard
+        return codes.legal_move_masks(board)
+
     def send_leds(self, message:bytes=(0).to_bytes(8,byteorder='big',signed=False)):
-        # logging.info(f'sending LED: {message}')
+        # logger.info(f'sending LED: {message}')
+        now = time.monotonic()
+        if message == self.last_leds:
+            if now - self.last_leds_time < self.settings.led_refresh_interval:
+                return
+        elif self.journal is not None:
+            self.journal.record_leds(message)
+        self.last_leds = message
+        self.last_leds_time = now
         self.serialthread.send_led(message)
 
     def diff_leds(self):
-        s1 = self.chessboard.board_fen()
+        if self.calibration or self.speed_mode == clock.SCRAMBLE:
+            # the calibration progress blinks the LEDs, in a time scramble they stay off
+            return
+        s1 = poscache.board_fen(self.chessboard)
         s2 = self.board_state_usb.split(" ")[0]
-        if (s1 != s2):
+        behind = self.resync.locate(s2) if s1 != s2 and poscache.board_fen(self.resync.board) == s1 else None
+        # None if the game moved on or was reset since locate(), e.g. by a takeback
+        following = self.resync.next_placement(s2) if behind else None
+        if following is not None:
+            # the board shows an older position of this game, light every square the next
+            # ply changes, so castling and en passant show the rook and the captured pawn too
+            self.send_leds(codes.squareset2ledbytes(codes.diff_mask(s2, following), self.rotate180))
+        elif (s1 != s2) or self.usb_unknown:
             diffmap = codes.diff2squareset(s1, s2)
-            # logging.debug(f'Difference on Squares:\n{diffmap}')
-            self.send_leds(codes.squareset2ledbytes(diffmap))
+            # logger.debug(f'Difference on Squares:\n{diffmap}')
+            # a piece of the side to move has been lifted, show where it can go
+            lifted = codes.lifted_square(self.chessboard, diffmap, poscache.base_board(s2))
+            if lifted is not None:
+                diffmap = diffmap | chess.SquareSet(self.get_move_masks().get(lifted, 0))
+            # flag squares we can't read
+            diffmap = diffmap | chess.SquareSet(self.usb_unknown)
+            self.send_leds(codes.squareset2ledbytes(diffmap, self.rotate180))
         else:
             self.send_leds()
 
-    def handle_usb_data(self, data):
-        usb_data = list(map(int, data.split(" ")))
+    def handle_usb_data(self, usb_data):
+        # usb_data is an immutable frame.BoardFrame, no copies needed for the history
         if self.calibration == True:
             self.calibrate_from_usb_data(usb_data)
-        else:
+        # while adding pieces (--addpiece) the existing calibration keeps decoding
+        if self.calibration == False or (not self.new_setup and len(self.calibration_data) > 0):
+            if self.usb_data_history_depth != self.settings.history_depth:
+                self.reset_history()
             if self.usb_data_history_i >= self.usb_data_history_depth:
                 self.usb_data_history_filled = True
                 self.usb_data_history_i = 0
 
-            self.usb_data_history[self.usb_data_history_i] = list(usb_data)[:]
+            self.usb_data_history[self.usb_data_history_i] = usb_data
             self.usb_data_history_i += 1
             if self.usb_data_history_filled:
-                self.usb_data_processed = codes.statistic_processing(self.usb_data_history, False)
+                # one reference per frame, a concurrent calibration update swaps in a new object
+                calibration = self.calibration_data
+                self.usb_data_processed = codes.statistic_processing(self.usb_data_history, False, calibration, self.settings.fuzzy_matching)
                 if self.usb_data_processed != []:
-                    test_state = codes.usb_data_to_FEN(self.usb_data_processed, self.rotate180)
+                    result = codes.decode_usb_data(self.usb_data_processed, calibration, self.rotate180, self.settings.fuzzy_matching)
+                    if self.detect_orientation(result):
+                        # the debounced frame is fine, only its mapping to squares changed
+                        result = codes.decode_usb_data(self.usb_data_processed, calibration, self.rotate180, self.settings.fuzzy_matching)
+                    board = self.chessboard
+                    # unknown squares are assumed unchanged, codes.get_moves_partial() checks that this is safe
+                    test_state = result.fen(board)
                     if test_state != "":
-                        if self.board_state_usb != test_state:
+                        if self.board_state_usb != test_state or self.usb_unknown != result.unknown:
                             new_position = True
                         else:
                             new_position = False
                         self.board_state_usb = test_state
+                        self.usb_unknown = result.unknown
+                        if new_position and self.journal is not None:
+                            self.journal.record_placement(test_state.split(" ")[0])
                         self.diff_leds()
                         if new_position:
                             # new board state via usb
-                            # logging.info(f'info string FEN {test_state}')
+                            # logger.info(f'info string FEN {test_state}')
                             if self.wait_for_move:
-                                logging.debug('trying to find user move in usb data')
+                                logger.debug('trying to find user move in usb data')
                                 try:
-                                    self.pending_moves = codes.get_moves(self.chessboard, self.board_state_usb, 1) # only search one move deep
+                                    if result.complete():
+                                        self.pending_moves = codes.get_moves(board, self.board_state_usb, 1, self.get_move_masks(board)) # only search one move deep
+                                    else:
+                                        self.pending_moves = codes.get_moves_partial(board, result, self.get_move_masks(board))
                                     if self.pending_moves != []:
-                                        logging.debug('firing event')
-                                        # self.chessboard.push_uci(self.pending_moves[0])
-                                        self.move_event.set()
+                                        self.moves_found(self.pending_moves, self.usb_data_processed, board)
+                                except codes.InvalidMove:
+                                    self.pending_moves = []
+                                    behind = self.resync.locate(self.board_state_usb.split(" ")[0])
+                                    if behind:
+                                        logger.info('board is %d plies behind the game', behind)
                                 except:
                                     self.pending_moves = []
+                            elif self.settings.premoves and result.complete() and board.turn != self.color:
+                                self.detect_premove(board)
+
+    def detect_premove(self, board):
+        """
+        During the opponent's turn, check whether the board shows one of our
+        moves made in advance. It is kept until the opponent's move arrives,
+        see take_premove().
+        """
+        premove_board = board.copy(stack=False)
+        premove_board.push(chess.Move.null())
+        try:
+            moves = codes.get_moves(premove_board, self.board_state_usb, 1)
+        except codes.InvalidMove:
+            moves = []
+        premove = None
+        if moves != []:
+            # the frame goes with the premove, it only becomes the move frame once the premove is sent
+            premove = (moves[0], self.board_state_usb, (self.usb_data_processed, premove_board))
+            logger.info('premove recorded: %s', moves[0])
+        elif self.premove is not None:
+            logger.info('premove %s taken back', self.premove[0])
+        self.premove = premove
+
+    def take_premove(self):
+        """
+        Called once the opponent's move is on self.chessboard. Returns the
+        recorded premove if the board still shows it and it is legal now,
+        else None. The premove is consumed either way.
+        """
+        premove = self.premove
+        self.premove = None
+        if premove is None:
+            return None
+        move, state, frame = premove
+        # a dropped premove must not leave an older frame for the learner either
+        self.move_frame = None
+        if state != self.board_state_usb or self.chessboard.turn != self.color:
+            return None
+        if chess.Move.from_uci(move) not in self.chessboard.legal_moves:
+            logger.info('premove %s is not legal after the opponent\'s move', move)
+            return None
+        self.move_frame = frame
+        self.move_detected_at = time.monotonic()
+        return move
+
+    def moves_found(self, moves, frame=None, board=None):
+        # frame and board are what the move was detected from, the learner uses them once it is confirmed
+        future = self.move_future
+        self.move_frame = (frame, board) if frame is not None else None
+        self.pending_moves = moves
+        self.move_detected_at = time.monotonic()
+        if future is not None:
+            if self.move_future is future:
+                self.move_future = None
+            try:
+                future.set_result(list(moves))
+            except concurrent.futures.InvalidStateError:
+                # cancelled in the meantime
+                pass
+        # bookkeeping only after the move is on its way
+        logger.debug('resolved move request with %s', moves)
+        if self.journal is not None:
+            self.journal.record_moves(moves)
+
+    def move_confirmed(self, move):
+        """
+        Our move has been accepted by lichess. Feed the code read on its
+        destination square to the learner, so worn or new chips get known.
+        """
+        if self.learner is None or self.move_frame is None:
+            return
+        frame, board = self.move_frame
+        self.move_frame = None
+        move = chess.Move.from_uci(move)
+        if move.promotion is not None:
+            piece = chess.Piece(move.promotion, board.turn)
+        else:
+            piece = board.piece_at(move.from_square)
+        if piece is None:
+            return
+        cell = codes.cell_codes(codes.square2cell(move.to_square, self.rotate180), frame)
+        if codes.cell_empty(cell):
+            return
+        if self.learner.observe(piece.symbol(), cell):
+            self.calibration_data = self.learner.calibration()
 
     def calibrate_from_usb_data(self, usb_data):
+        if self.calibration_job is not None:
+            # averaging is running in a worker, keep draining frames meanwhile
+            return
         self.calibration_samples.append(usb_data)
-        logging.info("    adding new calibration sample")
+        logger.info("    adding new calibration sample")
         self.calibration_samples_counter += 1
-        if self.calibration_samples_counter >= 15:
-            logging.info( "------- we have collected enough samples for averaging ----")
-            usb_data = codes.statistic_processing_for_calibration( self.calibration_samples, False)
-            codes.calibration(usb_data, self.new_setup, CALIBRATION_DATA)
-            self.calibration = False
-            logging.info('calibration ok') 
-            self.send_leds()
+        if self.calibration_samples_counter >= self.settings.calibration_samples:
+            logger.info( "------- we have collected enough samples for averaging ----")
+            self.calibration_job = self.offloader.submit(
+                codes.statistic_processing_for_calibration, list(self.calibration_samples), False,
+                callback=self.finish_calibration, errback=self.calibration_failed)
         elif self.calibration_samples_counter %2:
             self.send_leds(b'\xff\xff\x00\x00\x00\x00\xff\xff')
         else:
             self.send_leds()
 
+    def calibration_failed(self, e):
+        # e.g. a killed worker process, start over with fresh samples instead of waiting forever
+        logger.info('calibration failed: %s, collecting new samples', e)
+        self.calibration_samples = []
+        self.calibration_samples_counter = 0
+        self.calibration_job = None
+
+    def shutdown(self):
+        self.offloader.shutdown()
+
+    def finish_calibration(self, usb_data):
+        # learned codes live in their own file, keep them out of calibration.bin
+        previous = self.learner.base if self.learner is not None else self.calibration_data
+        calibration = codes.calibration(usb_data, self.new_setup, CALIBRATION_DATA, previous)
+        if self.learner is not None:
+            self.learner.base = calibration
+            calibration = self.learner.calibration()
+        self.calibration_data = calibration
+        self.calibration = False
+        self.calibration_job = None
+        logger.info('calibration ok') 
+        self.send_leds()
+
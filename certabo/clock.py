@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2020 by Harald Klein <hari@vt100.at> - All rights reserved
+#
+
+import datetime
+import logging
+
+import chess
+
+logger = logging.getLogger(__name__)
+
+NORMAL = 'normal'
+LOW = 'low'             # shorter debounce, coalesced LEDs
+SCRAMBLE = 'scramble'   # minimal debounce, no LEDs, info logging suppressed
+MODES = (NORMAL, LOW, SCRAMBLE)
+
+EPOCH = datetime.datetime(1970, 1, 1, tzinfo=datetime.timezone.utc)
+
+
+def clock_seconds(value):
+    """
+    Remaining time from a gameState clock field. Depending on the berserk
+    version that's a datetime relative to the epoch, a timedelta or an int in
+    milliseconds.
+    """
+    if value is None:
+        return None
+    if isinstance(value, datetime.datetime):
+        if value.tzinfo is None:
+            value = value.replace(tzinfo=datetime.timezone.utc)
+        return (value - EPOCH).total_seconds()
+    if isinstance(value, datetime.timedelta):
+        return value.total_seconds()
+    return value / 1000
+
+
+def mode_settings(settings, mode):
+    """ the effective board settings for a speed mode """
+    if mode == LOW:
+        return settings.replace(history_depth=min(settings.history_depth, 2),
+                                led_refresh_interval=max(settings.led_refresh_interval, 0.25))
+    if mode == SCRAMBLE:
+        return settings.replace(history_depth=1)
+    return settings
+
+
+class ClockPolicy():
+    """
+    Picks the board speed mode from our remaining time and keeps move latency
+    statistics (detection on the board to accepted by lichess) per mode.
+    """
+
+    def __init__(self, settings):
+        self.settings = settings
+        self.mode = NORMAL
+        self.latency = {mode: [0, 0.0, 0.0] for mode in MODES}  # count, total, max
+
+    def mode_for(self, seconds):
+        if seconds is None:
+            return NORMAL
+        if seconds < self.settings.scramble_threshold:
+            return SCRAMBLE
+        if seconds < self.settings.low_time_threshold:
+            return LOW
+        return NORMAL
+
+    def update(self, game_state, color):
+        """ returns (mode, changed) for a gameState event """
+        field = 'wtime' if color == chess.WHITE else 'btime'
+        seconds = clock_seconds(game_state.get(field))
+        mode = self.mode_for(seconds)
+        changed = mode != self.mode
+        if changed:
+            logger.info('clock %.1fs, switching from %s to %s mode', seconds, self.mode, mode)
+            self.mode = mode
+        return mode, changed
+
+    def record_latency(self, seconds, mode=None):
+        stats = self.latency[mode or self.mode]
+        stats[0] += 1
+        stats[1] += seconds
+        stats[2] = max(stats[2], seconds)
+
+    def summary(self):
+        return {mode: (count, total / count, worst)
+                for mode, (count, total, worst) in self.latency.items() if count}
@@ -1,15 +1,28 @@
 from __future__ import print_function
 import pickle
-import os
+import types
 import chess
 import logging
-import struct
 
-# data conversion
-p, r, n, b, k, q, P, R, N, B, K, Q = [], [], [], [], [], [], [], [], [], [], [], []
+from certabo import poscache
+from certabo.frame import BoardFrame, pack_code
+
+logger = logging.getLogger(__name__)
+
+# piece order in the calibration file
+PIECES = "p", "r", "n", "b", "k", "q", "P", "R", "N", "B", "K", "Q"
+# lookup precedence if a code is calibrated for several pieces, the last one wins
+LOOKUP_ORDER = "p", "P", "r", "R", "n", "N", "b", "B", "q", "Q", "k", "K"
+
+# confidence reported for a code that matches a calibrated one in 4 of 5 bytes
+NEAR_MATCH_CONFIDENCE = 0.8
+# packed code with one of the 5 bytes cleared
+NEAR_MASKS = tuple(0xffffffffff & ~(0xff << (8 * (4 - i))) for i in range(5))
 
 # for calibration
 def cell_codes(n_cell, usb_data):  # n_cell from 0 to 63, 0 at left top
+    if isinstance(usb_data, BoardFrame):
+        return usb_data.cell(n_cell)
     result = []
     for i in range(5):
         result.append(usb_data[n_cell * 5 + i])
@@ -24,6 +37,108 @@ def compare_cells(x, y):
         return False
 
 
+class CodeIndex():
+    """
+    Lookup table from RFID codes to piece names.
+
+    Codes are packed into ints (see frame.pack_code). Besides the exact codes,
+    every code is also stored once per byte position with that byte masked
+    out. A code with a single wrong byte then resolves with at most five dict
+    lookups, and is rejected as ambiguous if the masked keys point to more
+    than one piece.
+    """
+
+    def __init__(self, pieces):
+        self.exact = {}
+        self.near = {}
+        # same order as the old linear scan, on duplicates the last piece wins
+        for name, cells in pieces:
+            for cell in cells:
+                code = pack_code(cell)
+                self.exact[code] = name
+                for i, mask in enumerate(NEAR_MASKS):
+                    self.near.setdefault((i, code & mask), set()).add(name)
+
+    def lookup(self, cell, fuzzy=True):
+        """ return (piece name, confidence), ("", 0.0) for unknown or ambiguous codes """
+        return self.lookup_code(pack_code(cell), fuzzy)
+
+    def lookup_code(self, code, fuzzy=True):
+        """ same as lookup() for a packed code """
+        name = self.exact.get(code)
+        if name is not None:
+            return name, 1.0
+        if not fuzzy:
+            return "", 0.0
+        found = set()
+        for i, mask in enumerate(NEAR_MASKS):
+            names = self.near.get((i, code & mask))
+            if names:
+                found |= names
+        if len(found) == 1:
+            return found.pop(), NEAR_MATCH_CONFIDENCE
+        return "", 0.0
+
+
+class Calibration():
+    """
+    Immutable mapping of RFID codes to pieces plus its lookup index.
+
+    Nothing in here changes after construction, updates build a new object
+    which the owner swaps in with a single attribute assignment. Readers that
+    grab the reference once per frame therefore never see a half updated table
+    and need no lock.
+    """
+    __slots__ = ("pieces", "index", "source")
+
+    def __init__(self, pieces=None, source=None):
+        pieces = pieces or {}
+        self.pieces = types.MappingProxyType(
+            {name: tuple(tuple(cell) for cell in pieces.get(name, ())) for name in PIECES}
+        )
+        self.index = CodeIndex((name, self.pieces[name]) for name in LOOKUP_ORDER)
+        self.source = source
+
+    @classmethod
+    def load(cls, filename):
+        """ load a calibration file, an empty calibration if there is none """
+        logger.info("codes.py - loading calibration")
+        try:
+            with open(filename, "rb") as f:
+                data = pickle.load(f)
+            return cls(dict(zip(PIECES, data)), filename)
+        except (IOError, OSError):
+            logger.info("WARNING: no calibration found")
+        except (ValueError, TypeError, pickle.UnpicklingError):
+            logger.info("Can't load calibration data")
+        return cls()
+
+    def save(self, filename):
+        # plain int lists in PIECES order, the file format predates this class
+        with open(filename, "wb") as f:
+            pickle.dump(tuple([list(cell) for cell in self.pieces[name]] for name in PIECES), f)
+
+    def lookup(self, cell, fuzzy=True):
+        return self.index.lookup(cell, fuzzy)
+
+    def lookup_code(self, code, fuzzy=True):
+        return self.index.lookup_code(code, fuzzy)
+
+    def merged(self, other):
+        """ new calibration with our codes plus those of other that we don't have yet """
+        pieces = {}
+        for name in PIECES:
+            cells = list(self.pieces[name])
+            for cell in other.pieces[name]:
+                if cell not in cells:
+                    cells.append(cell)
+            pieces[name] = cells
+        return Calibration(pieces, self.source)
+
+    def __len__(self):
+        return sum(len(cells) for cells in self.pieces.values())
+
+
 def get_calibration_file_name(port):
     if port is None:
         return "calibration.bin"
@@ -32,19 +147,7 @@ def get_calibration_file_name(port):
 
 
 def load_calibration(filename):
-    global p, r, n, b, k, q, P, R, N, B, K, Q
-    logging.info("codes.py - loading calibration")
-    try:
-        p, r, n, b, k, q, P, R, N, B, K, Q = pickle.load(
-            open(filename, "rb")
-        )
-    except (IOError, OSError):
-        logging.info("WARNING: no calibration found")
-        return False
-    except ValueError:
-        logging.info("Can't load calibration data")
-        return False
-    return True
+    return Calibration.load(filename)
 
 
 def statistic_processing_for_calibration(samples, show_print):
@@ -54,11 +157,11 @@ def statistic_processing_for_calibration(samples, show_print):
         cells = []
         #        if show_print: print "\n    cell n =",n_cell,letter[n_cell%8]+str(8-n_cell/8), "   samples:"
         if show_print:
-            logging.info("\n    %s   samples:", letter[n_cell % 8] + str(8 - n_cell / 8))
+            logger.info("\n    %s   samples:", letter[n_cell % 8] + str(8 - n_cell / 8))
         for usb_data in samples:
             cells.append(cell_codes(n_cell, usb_data))
             if show_print:
-                logging.info("%s", cell_codes(n_cell, usb_data))
+                logger.info("%s", cell_codes(n_cell, usb_data))
         histograms = []
         for cell in cells:
             histogram = 0
@@ -74,93 +177,49 @@ def statistic_processing_for_calibration(samples, show_print):
         for i in cells[max_index]:
             result.append(i)
         if show_print:
-            logging.info("---final code: %s", " ".join(map(str, result)))
+            logger.info("---final code: %s", " ".join(map(str, result)))
 
-    return result
+    return BoardFrame(result)
 
 
-def get_name(cell):
-    global p, r, n, b, k, q, P, R, N, B, K, Q
+def get_name(cell, calibration, fuzzy=True):
     c = ""
     if cell_empty(cell):
         c = "-"
-    for cell_p in p:
-        if compare_cells(cell, cell_p):
-            c = "p"
-    for cell_p in P:
-        if compare_cells(cell, cell_p):
-            c = "P"
-    for cell_p in r:
-        if compare_cells(cell, cell_p):
-            c = "r"
-    for cell_p in R:
-        if compare_cells(cell, cell_p):
-            c = "R"
-    for cell_p in n:
-        if compare_cells(cell, cell_p):
-            c = "n"
-    for cell_p in N:
-        if compare_cells(cell, cell_p):
-            c = "N"
-    for cell_p in b:
-        if compare_cells(cell, cell_p):
-            c = "b"
-    for cell_p in B:
-        if compare_cells(cell, cell_p):
-            c = "B"
-    for cell_p in q:
-        if compare_cells(cell, cell_p):
-            c = "q"
-    for cell_p in Q:
-        if compare_cells(cell, cell_p):
-            c = "Q"
-    for cell_p in k:
-        if compare_cells(cell, cell_p):
-            c = "k"
-    for cell_p in K:
-        if compare_cells(cell, cell_p):
-            c = "K"
+    name, confidence = calibration.lookup(cell, fuzzy and c == "")
+    if name != "":
+        c = name
     return c
 
 
-def statistic_processing(samples, show_print):
+def statistic_processing(samples, show_print, calibration, fuzzy=True):
     global letters
     result = []
-    found_unknown_cell = False
     for n_cell in range(64):
         cells = []
         #        if show_print: print "\n    cell n =",n_cell,letter[n_cell%8]+str(8-n_cell/8), "   samples:"
         if show_print:
-            logging.info("\n    %s    samples:", letter[n_cell % 8] + str(8 - n_cell / 8))
+            logger.info("\n    %s    samples:", letter[n_cell % 8] + str(8 - n_cell / 8))
         for usb_data in samples:
             cells.append(cell_codes(n_cell, usb_data))
             if show_print:
-                logging.info("%s", cell_codes(n_cell, usb_data))
+                logger.info("%s", cell_codes(n_cell, usb_data))
         histograms = []
 
         known_cells = []
         for cell in cells:  # stack of history of cell codes for one cell
-            name = get_name(cell)
-            if name != "":
+            if get_name(cell, calibration, fuzzy) != "":
                 known_cells.append(cell)
-            elif name == "-":           
-                cell = 0, 0, 0, 0, 0
-            # [edit] ignore unknown codes and replace it with 0
-            else:            	
-               	cell = 0, 0, 0, 0, 0            	    
-               	known_cells.append(cell)
-            # [endedit]   	
 
         if len(known_cells) == 0:
-            logging.info(
-                "Found only unknown cell codes in cell %s:",
-                letter[n_cell % 8] + str(8 - n_cell / 8),
+            # keep the most frequent raw code, the decoder marks the square as unknown
+            # and the other 63 squares of the frame are still usable
+            logger.info(
+                "Found only unknown cell codes in cell %s: %s",
+                letter[n_cell % 8] + str(8 - n_cell // 8),
+                cells,
             )
-            for cell in cells:  # stack of history of cell codes for one cell
-                logging.info("%s", cell)
-
-            found_unknown_cell = True
-            break
+            known_cells = cells
 
         for cell in known_cells:  # stack of history of cell codes for one cell
             histogram = 0
@@ -177,12 +236,9 @@ def statistic_processing(samples, show_print):
             result.append(i)
         if show_print:
             if show_print:
-                logging.info("---final code: %s", " ".join(map(str, result)))
+                logger.info("---final code: %s", " ".join(map(str, result)))
 
-    if found_unknown_cell:
-        return []
-
-    return result
+    return BoardFrame(result)
 
 
 # ---------------------------
@@ -197,301 +253,251 @@ def cell_empty(x):
         return False
 
 
-def calibration(usb_data, new_setup, filename):
-    global p, r, n, b, k, q, P, R, N, B, K, Q
-    prev_results = p, r, n, b, k, q, P, R, N, B, K, Q
-
-    p, r, n, b, k, q, P, R, N, B, K, Q = [], [], [], [], [], [], [], [], [], [], [], []
+def calibration_from_start_position(usb_data):
+    """ read the codes of all pieces from a frame of the starting position """
+    pieces = {name: [] for name in PIECES}
     empty_cell = [0, 0, 0, 0, 0]
     # pawns
     for i in range(8):  # each place at board
         cell = cell_codes(8 + i, usb_data)
         if not compare_cells(cell, empty_cell):
-            p.append(cell_codes(8 + i, usb_data))
+            pieces["p"].append(cell)
         cell = cell_codes(48 + i, usb_data)
         if not cell_empty(cell):  # not empty
-            P.append(cell_codes(48 + i, usb_data))
-
-    r.append(cell_codes(0, usb_data))
-    r.append(cell_codes(7, usb_data))
-    R.append(cell_codes(56, usb_data))
-    R.append(cell_codes(63, usb_data))
-
-    n.append(cell_codes(1, usb_data))
-    n.append(cell_codes(6, usb_data))
-    N.append(cell_codes(57, usb_data))
-    N.append(cell_codes(62, usb_data))
-
-    b.append(cell_codes(2, usb_data))
-    b.append(cell_codes(5, usb_data))
-    B.append(cell_codes(58, usb_data))
-    B.append(cell_codes(61, usb_data))
-
-    q.append(cell_codes(3, usb_data))
-    Q.append(cell_codes(59, usb_data))
-
-    k.append(cell_codes(4, usb_data))
-    K.append(cell_codes(60, usb_data))
-
-    pp, rp, np, bp, kp, qp, Pp, Rp, Np, Bp, Kp, Qp = prev_results
-    results = p, r, n, b, k, q, P, R, N, B, K, Q
-
-    pn, rn, nn, bn, kn, qn, Pn, Rn, Nn, Bn, Kn, Qn = (
-        p[:],
-        r[:],
-        n[:],
-        b[:],
-        k[:],
-        q[:],
-        P[:],
-        R[:],
-        N[:],
-        B[:],
-        K[:],
-        Q[:],
-    )
-
-    def add_new(pnew, pcurrent, pprevious):
-        for previous in pprevious:
-            previous_not_in_current = True
-            for current in pcurrent:
-                if compare_cells(current, previous):
-                    previous_not_in_current = False
-                    break
-            if previous_not_in_current:
-                logging.info("previous not in current")
-                pnew.append(previous)
-            else:
-                logging.info("previous in current")
-        return pnew
-
-    logging.info("Q before = %s", Qn)
-
-    pn = add_new(pn, p, pp)
-    rn = add_new(rn, r, rp)
-    nn = add_new(nn, n, np)
-    bn = add_new(bn, b, bp)
-    kn = add_new(kn, k, kp)
-    qn = add_new(qn, q, qp)
-    Pn = add_new(Pn, P, Pp)
-    Rn = add_new(Rn, R, Rp)
-    Nn = add_new(Nn, N, Np)
-    Bn = add_new(Bn, B, Bp)
-    Kn = add_new(Kn, K, Kp)
-    Qn = add_new(Qn, Q, Qp)
-    logging.info("Q after = %s", Qn)
-
-    # compare_cells( cell, cell_p )
-    if not new_setup:
-        logging.info("------- not new setup ----")
-        results = pn, rn, nn, bn, kn, qn, Pn, Rn, Nn, Bn, Kn, Qn
-        p, r, n, b, k, q, P, R, N, B, K, Q = (
-            pn,
-            rn,
-            nn,
-            bn,
-            kn,
-            qn,
-            Pn,
-            Rn,
-            Nn,
-            Bn,
-            Kn,
-            Qn,
-        )
-    pickle.dump(results, open(filename, "wb"))
+            pieces["P"].append(cell)
 
-    logging.info("----------------")
-    # print r
-    #    print compare_cells(p[0], p[1])
+    for name, cells in (("r", (0, 7)), ("R", (56, 63)), ("n", (1, 6)), ("N", (57, 62)),
+                        ("b", (2, 5)), ("B", (58, 61)), ("q", (3,)), ("Q", (59,)),
+                        ("k", (4,)), ("K", (60,))):
+        for n_cell in cells:
+            pieces[name].append(cell_codes(n_cell, usb_data))
+    return Calibration(pieces)
 
+
+def calibration(usb_data, new_setup, filename, previous=None):
+    """
+    Calibrate from a frame of the starting position and save the result.
+    Unless new_setup is set the codes of the previous calibration are kept
+    (e.g. for a second set of pieces). Returns the new Calibration.
+    """
+    result = calibration_from_start_position(usb_data)
+    if not new_setup and previous is not None:
+        logger.info("------- not new setup ----")
+        result = result.merged(previous)
+    result = Calibration(result.pieces, filename)
+    result.save(filename)
+    logger.info("calibration has %d codes", len(result))
+
+    logger.info("----------------")
     for j in range(8):
         row = []
         for i in range(8):
-            cell = cell_codes(i + j * 8, usb_data)
-            # print cell
-            # print empty_cell
-            if cell_empty(cell):
-                row.append("-")
-            else:  # not empty
-                for cell_p in p:
-                    if compare_cells(cell, cell_p):
-                        row.append("p")
-                for cell_p in P:
-                    if compare_cells(cell, cell_p):
-                        row.append("P")
-                for cell_p in r:
-                    if compare_cells(cell, cell_p):
-                        row.append("r")
-                for cell_p in R:
-                    if compare_cells(cell, cell_p):
-                        row.append("R")
-                for cell_p in n:
-                    if compare_cells(cell, cell_p):
-                        row.append("n")
-                for cell_p in N:
-                    if compare_cells(cell, cell_p):
-                        row.append("N")
-                for cell_p in b:
-                    if compare_cells(cell, cell_p):
-                        row.append("b")
-                for cell_p in B:
-                    if compare_cells(cell, cell_p):
-                        row.append("B")
-                for cell_p in q:
-                    if compare_cells(cell, cell_p):
-                        row.append("q")
-                for cell_p in Q:
-                    if compare_cells(cell, cell_p):
-                        row.append("Q")
-                for cell_p in k:
-                    if compare_cells(cell, cell_p):
-                        row.append("k")
-                for cell_p in K:
-                    if compare_cells(cell, cell_p):
-                        row.append("K")
-        logging.info(" ".join(row))
+            name = get_name(cell_codes(i + j * 8, usb_data), result, False)
+            row.append(name if name != "" else "?")
+        logger.info(" ".join(row))
+    return result
 
 
 letter = "a", "b", "c", "d", "e", "f", "g", "h"
-reversed_letter = tuple(reversed(letter))
+
+# Board orientation as a permutation of square indices. Cell 0 is the top left
+# corner seen from the connector side. A board turned by 180 degrees (black
+# pieces on the connector side) maps every square s to 63 - s, for the cells
+# as well as for the LED bitmask.
+CELL_SQUARES = {
+    False: tuple(chess.square(n_cell % 8, 7 - n_cell // 8) for n_cell in range(64)),
+    True: tuple(chess.square(7 - n_cell % 8, n_cell // 8) for n_cell in range(64)),
+}
+SQUARE_CELLS = {rotate180: tuple(squares.index(square) for square in range(64))
+                for rotate180, squares in CELL_SQUARES.items()}
+
+REVERSED_BYTES = bytes(int('{:08b}'.format(i)[::-1], 2) for i in range(256))
 
 
 def reverse_bits(n):
-    return int('{:064b}'.format(n)[::-1], 2)
+    # reversing 64 bits is reversing the byte order and the bits in each byte
+    return int.from_bytes(n.to_bytes(8, 'little').translate(REVERSED_BYTES), 'big')
+
+
+def rotate_pieces(pieces):
+    """ per-square list (e.g. DecodeResult.pieces) as seen with the other orientation """
+    return pieces[::-1]
+
+
+# DecodeResult.pieces of the starting position decoded with the wrong orientation
+ROTATED_START_PIECES = rotate_pieces([piece.symbol() if piece is not None else "-"
+                                      for piece in map(chess.Board().piece_at, chess.SQUARES)])
 
 
 def move2led(move, rotate180=False):
-    if rotate180:
-        i = reversed_letter.index(move[2])
-        j = 9 - int(move[3])
-        k = reversed_letter.index(move[0])
-        l = 9 - int(move[1])
-    else:
-        i = letter.index(move[2])
-        j = int(move[3])
-        k = letter.index(move[0])
-        l = int(move[1])
-    return 8 - j, 2 ** i, 8 - l, 2 ** k
+    """ LED row and bit value of the destination and the origin of a move """
+    if isinstance(move, str):
+        move = chess.Move.from_uci(move)
+    to_cell = square2cell(move.to_square, rotate180)
+    from_cell = square2cell(move.from_square, rotate180)
+    return to_cell // 8, 2 ** (to_cell % 8), from_cell // 8, 2 ** (from_cell % 8)
 
 def move2ledbytes(move, rotate180=False):
-    i, value, i_source, value_source = move2led(move, rotate180)
-    message = bytearray()
-    for j in range(8):
-        if j != i and j != i_source:
-            message.append(0)
-        elif j == i and j == i_source:
-            message.append(value + value_source)
-        elif j == i:
-            message.append(value)
-        else:
-            message.append(value_source)
-    return message
+    if isinstance(move, str):
+        move = chess.Move.from_uci(move)
+    squares = chess.BB_SQUARES[move.from_square] | chess.BB_SQUARES[move.to_square]
+    return squareset2ledbytes(squares, rotate180)
 
 def diff2squareset(s1, s2):
-    board1 = chess.BaseBoard(s1)
-    board2 = chess.BaseBoard(s2)
-    diffmap = chess.SquareSet()
+    return chess.SquareSet(diff_mask(s1, s2))
+
+def compute_diff_mask(s1, s2):
+    board1 = poscache.base_board(s1)
+    board2 = poscache.base_board(s2)
+    mask = 0
     for x in range(chess.A1, chess.H8+1):
         if board1.piece_at(x) != board2.piece_at(x):
-            diffmap.add(x)
-    return diffmap
+            mask |= chess.BB_SQUARES[x]
+    return mask
 
-def squareset2ledbytes(squareset):
-    # we pack the uint64 squareset bitmask into a big endian bytearray
-    return int(squareset).to_bytes(8, byteorder="big", signed=False)
+diff_mask_cache = poscache.LRUCache('diff_mask', 256)
 
-def usb_data_to_FEN(usb_data, rotate180=False):
-    global letter
-    empty_cell = [0, 0, 0, 0, 0]
-    s = ""
-    was_unknown_piece = False
-    for j in range(8):
+def diff_mask(s1, s2):
+    """ bitmask of the squares that differ between two placements, memoized """
+    return diff_mask_cache.get((s1, s2), compute_diff_mask, s1, s2)
 
-        c = ""
-        empty_cells_counter = 0
-        for i in range(8):
-            cell = cell_codes(i + j * 8, usb_data)
-            c = "unknown"
-
-            if cell_empty(cell):
-                c = "-"
-                empty_cells_counter += 1
-            else:  # not empty
-
-                for cell_p in p:
-                    if compare_cells(cell, cell_p):
-                        c = "p"
-                for cell_p in P:
-                    if compare_cells(cell, cell_p):
-                        c = "P"
-                for cell_p in r:
-                    if compare_cells(cell, cell_p):
-                        c = "r"
-                for cell_p in R:
-                    if compare_cells(cell, cell_p):
-                        c = "R"
-                for cell_p in n:
-                    if compare_cells(cell, cell_p):
-                        c = "n"
-                for cell_p in N:
-                    if compare_cells(cell, cell_p):
-                        c = "N"
-                for cell_p in b:
-                    if compare_cells(cell, cell_p):
-                        c = "b"
-                for cell_p in B:
-                    if compare_cells(cell, cell_p):
-                        c = "B"
-                for cell_p in q:
-                    if compare_cells(cell, cell_p):
-                        c = "q"
-                for cell_p in Q:
-                    if compare_cells(cell, cell_p):
-                        c = "Q"
-                for cell_p in k:
-                    if compare_cells(cell, cell_p):
-                        c = "k"
-                for cell_p in K:
-                    if compare_cells(cell, cell_p):
-                        c = "K"
-
-                if empty_cells_counter > 0 and c != "-":
-                    s += str(empty_cells_counter)
-                    empty_cells_counter = 0
-                    s += c
-                elif empty_cells_counter == 0 and c != "-":
-                    s += c
-                if c == "unknown":
-                    #                    print "Unknown piece at cell n =",j*8+i, ", ",letter[i]+str(8-j)
-                    logging.info("Unknown piece at %s", letter[i] + str(8 - j))
-                    was_unknown_piece = True
-        if empty_cells_counter > 0 and c == "-":
-            s += str(empty_cells_counter)
-            empty_cells_counter = 0
-
-        if j != 7:
-            s += r"/"
-
-        # s += c
-        # ss = ""
-        # for i in range(8):
+def compute_legal_move_masks(board):
+    masks = {}
+    for move in board.generate_legal_moves():
+        masks[move.from_square] = masks.get(move.from_square, 0) | chess.BB_SQUARES[move.to_square]
+    return masks
 
-    # "rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1"
+move_masks_cache = poscache.LRUCache('legal_move_masks', 128)
+
+def legal_move_masks(board):
+    """
+    Map each origin square to the bitmask of its legal destination squares.
+    Memoized per position, the returned dict is shared and must not be modified.
+
+    :param board: position to generate the table for
+    :type board: chess.Board
+    :return: dict of square -> int bitmask
+    """
+    return move_masks_cache.get(poscache.position_key(board), compute_legal_move_masks, board)
+
+def lifted_square(board, diffmap, usb_board):
+    """
+    Return the origin square if the physical board only lacks pieces compared to
+    board and exactly one of them belongs to the side to move, else None.
+    Covers a plain lift as well as a capture where the captured piece was taken
+    off first.
+    """
+    lifted = None
+    for square in diffmap:
+        if usb_board.piece_at(square) is not None:
+            return None
+        piece = board.piece_at(square)
+        if piece is not None and piece.color == board.turn:
+            if lifted is not None:
+                return None
+            lifted = square
+    return lifted
+
+def squareset2ledbytes(squareset, rotate180=False):
+    # we pack the uint64 squareset bitmask into a big endian bytearray
+    mask = int(squareset)
     if rotate180:
-        s = '/'.join(row[::-1] for row in reversed(s.split('/')))
-    s += " w KQkq - 0 1"
-    if was_unknown_piece:
+        mask = reverse_bits(mask)
+    return mask.to_bytes(8, byteorder="big", signed=False)
+
+class DecodeResult():
+    """
+    Per-square result of decoding a frame.
+
+    pieces holds one symbol per chess square (a1 = 0): a piece letter, "-" for
+    an empty square or "" for a code that couldn't be resolved. unknown is the
+    bitmask of those unresolved squares.
+    """
+    __slots__ = ("pieces", "unknown")
+
+    def __init__(self, pieces, unknown):
+        self.pieces = pieces
+        self.unknown = unknown
+
+    def complete(self):
+        return self.unknown == 0
+
+    def board_fen(self, fill=None):
+        """
+        Placement part of the FEN. Unknown squares take their piece from the
+        fill board (usually the last known position), or are left empty.
+        """
+        rows = []
+        for rank in range(7, -1, -1):
+            row = ""
+            empty = 0
+            for file in range(8):
+                square = rank * 8 + file
+                c = self.pieces[square]
+                if c == "":
+                    piece = fill.piece_at(square) if fill is not None else None
+                    c = piece.symbol() if piece is not None else "-"
+                if c == "-":
+                    empty += 1
+                    continue
+                if empty:
+                    row += str(empty)
+                    empty = 0
+                row += c
+            if empty:
+                row += str(empty)
+            rows.append(row)
+        return "/".join(rows)
+
+    def fen(self, fill=None):
+        return self.board_fen(fill) + " w KQkq - 0 1"
+
+
+def square2cell(square, rotate180=False):
+    """ inverse of the cell to square mapping in decode_usb_data() """
+    return SQUARE_CELLS[rotate180][square]
+
+
+def decode_usb_data(usb_data, calibration, rotate180=False, fuzzy=True):
+    index = calibration.index
+    squares = CELL_SQUARES[rotate180]
+    pieces = [""] * 64
+    unknown = 0
+    for n_cell in range(64):
+        square = squares[n_cell]
+        cell = cell_codes(n_cell, usb_data)
+        if cell_empty(cell):
+            pieces[square] = "-"
+            continue
+        name, confidence = index.lookup_code(pack_code(cell), fuzzy)
+        if name == "":
+            logger.info("Unknown piece at %s", chess.square_name(square))
+            unknown |= chess.BB_SQUARES[square]
+        elif confidence < 1.0:
+            logger.debug("Near match %s at %s", name, chess.square_name(square))
+        pieces[square] = name
+    return DecodeResult(pieces, unknown)
+
+
+def usb_data_to_FEN(usb_data, calibration, rotate180=False, fuzzy=True):
+    # "rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1"
+    result = decode_usb_data(usb_data, calibration, rotate180, fuzzy)
+    if not result.complete():
         return ""
-    # print s
-    return s
+    return result.fen()
 
 
 black_pieces = "r", "b", "k", "n", "p", "q"
 white_pieces = "R", "B", "K", "N", "P", "Q"
 
+fen2board_cache = poscache.LRUCache('FEN2board', 64)
+
 # convert FEN to 2d list with user playing pieces
 def FEN2board(FEN_string, play_white):
+    # memoized, the returned rows are shared and must not be modified
+    return fen2board_cache.get((FEN_string, play_white), compute_FEN2board, FEN_string, play_white)
+
+def compute_FEN2board(FEN_string, play_white):
 
     if play_white:
         pieces = white_pieces
@@ -521,8 +527,8 @@ def FEN2board(FEN_string, play_white):
 
 
 def FENs2move(FEN_prev, FEN, play_white):
-    logging.info("---------------------- FENs2move() --------------------")
-    logging.info("FEN_prev=%s FEN=%s", FEN_prev, FEN)
+    logger.debug("---------------------- FENs2move() --------------------")
+    logger.debug("FEN_prev=%s FEN=%s", FEN_prev, FEN)
 
     board_prev = FEN2board(FEN_prev, play_white)
     board = FEN2board(FEN, play_white)
@@ -565,9 +571,9 @@ def FENs2move(FEN_prev, FEN, play_white):
         row = "2"
 
     if pawn in p_from:
-        logging.info("Movement %s", pawn)
+        logger.debug("Movement %s", pawn)
         if row in p_from[pawn]:
-            logging.info("Found conversion !")
+            logger.debug("Found conversion !")
             for key in p_to:
                 if key != pawn:
                     move = p_from[pawn] + p_to[key] + key
@@ -584,7 +590,7 @@ def FENs2move(FEN_prev, FEN, play_white):
             if key in p_to:
                 move = p_from[key] + p_to[key]
 
-    logging.info("------------ move found: %s ------------------", move)
+    logger.debug("------------ move found: %s ------------------", move)
     return move
 
 
@@ -592,38 +598,96 @@ class InvalidMove(Exception):
     pass
 
 
-def get_moves(board, fen, max_depth =2):
+def known_placement_key(board, known):
+    """ poscache.placement_key() restricted to the squares in the known bitmask """
+    return (board.pawns & known, board.knights & known, board.bishops & known, board.rooks & known,
+            board.queens & known, board.kings & known,
+            board.occupied_co[chess.WHITE] & known, board.occupied_co[chess.BLACK] & known)
+
+
+def get_moves_partial(board, result, masks=None):
+    """
+    Single move detection on a frame with unknown squares.
+
+    An unknown square holds some piece we can't name. A legal move is accepted
+    if it starts on a square that changed, ends on a changed or an unknown
+    square, matches the frame on every known square and leaves all unknown
+    squares occupied. That includes a move onto a square with an uncalibrated
+    code, so the learner gets to see it. Exactly one move has to match,
+    otherwise InvalidMove is raised.
+    """
+    if masks is None:
+        masks = legal_move_masks(board)
+    fen = result.fen(board)
+    diffmask = diff_mask(poscache.board_fen(board), fen.split()[0])
+    known = chess.BB_ALL & ~result.unknown
+    target = known_placement_key(poscache.base_board(fen.split()[0]), known)
+    destinations = diffmask | result.unknown
+    origins = 0
+    for square, square_destinations in masks.items():
+        if diffmask & chess.BB_SQUARES[square] and square_destinations & destinations:
+            origins |= chess.BB_SQUARES[square]
+    copy_board = board.copy(stack=False)
+    matches = []
+    for move in board.generate_legal_moves(from_mask=origins, to_mask=destinations):
+        copy_board.push(move)
+        if (known_placement_key(copy_board, known) == target
+                and copy_board.occupied & result.unknown == result.unknown):
+            matches.append(move.uci())
+        copy_board.pop()
+    if len(matches) != 1:
+        logger.debug('%d moves explain the frame with unknown squares %s', len(matches),
+                     chess.SquareSet(result.unknown))
+        raise InvalidMove()
+    logger.debug('Single move detected with unknown squares - %s', matches[0])
+    return matches
+
+
+def get_moves(board, fen, max_depth =2, masks=None):
     """
     :param board:
     :type board: chess.Board
     :param fen:
     :param max_depth:
+    :param masks: legal_move_masks(board), computed if not given
     :return:
     """
     board_fen = fen.split()[0]
-    # logging.debug('Getting diff between {} and {}'.format(board.board_fen(), board_fen))
-    if board.board_fen() == board_fen:
-        # logging.debug('Positions identical')
+    current_fen = poscache.board_fen(board)
+    # logger.debug('Getting diff between {} and {}'.format(current_fen, board_fen))
+    if current_fen == board_fen:
+        # logger.debug('Positions identical')
         return []
     copy_board = board.copy()  # type: chess.Board
-    moves = list(board.generate_legal_moves())
-    for move in moves:
+    # a single move has to start and end on a square that changed, so only origins
+    # with a legal destination among the changed squares are worth a full position match
+    if masks is None:
+        masks = legal_move_masks(board)
+    diffmask = diff_mask(current_fen, board_fen)
+    # compare packed placements instead of building a FEN per candidate
+    target = poscache.placement_key(poscache.base_board(board_fen))
+    origins = 0
+    for square, destinations in masks.items():
+        if diffmask & chess.BB_SQUARES[square] and destinations & diffmask:
+            origins |= chess.BB_SQUARES[square]
+    for move in board.generate_legal_moves(from_mask=origins, to_mask=diffmask):
         copy_board.push(move)
-        if board_fen == copy_board.board_fen():
-            logging.debug('Single move detected - {}'.format(move.uci()))
+        if target == poscache.placement_key(copy_board):
+            logger.debug('Single move detected - %s', move)
             return [move.uci()]
         copy_board.pop()
     if max_depth > 1:
+        moves = list(board.generate_legal_moves())
         for move in moves:
             copy_board.push(move)
             legal_moves2 = list(copy_board.generate_legal_moves())
             for move2 in legal_moves2:
                 copy_board.push(move2)
-                if board_fen == copy_board.board_fen():
-                    logging.debug('Double move detected - {}, {}'.format(move.uci(), move2.uci()))
+                if target == poscache.placement_key(copy_board):
+                    logger.debug('Double move detected - %s, %s', move, move2)
                     return [move.uci(), move2.uci()]
                 copy_board.pop()
             copy_board.pop()
-    logging.debug('Unable to detect moves')
+    logger.debug('Unable to detect moves')
     raise InvalidMove()
 
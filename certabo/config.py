@@ -0,0 +1,200 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2020 by Harald Klein <hari@vt100.at> - All rights reserved
+#
+
+import os
+import signal
+import logging
+import dataclasses
+
+logger = logging.getLogger(__name__)
+
+
+@dataclasses.dataclass(frozen=True)
+class Settings:
+    # connection, only read at startup
+    port: str = 'auto'
+    tokenfile: str = './lichess.token'
+    baudrate: int = 38400
+    worker_processes: int = 0           # process pool for calibration averaging, 0 = off
+    stall_timeout: float = 5.0          # seconds without data from the board before it counts as stalled
+    link_stats_interval: float = 0.0    # log serial link statistics every that many seconds, 0 = off
+    correspondence: bool = False
+    debug: bool = False
+    # board pipeline tuning, can be changed at runtime
+    orientation: str = 'auto'           # 'normal', 'rotated' (black on the connector side) or 'auto'
+    history_depth: int = 3              # frames used for debouncing a position
+    fuzzy_matching: bool = True         # accept codes with one wrong byte if unambiguous
+    online_learning: bool = True        # learn codes of pieces from confirmed moves
+    learned_codes_max: int = 64
+    premoves: bool = True               # send a move made during the opponent's turn right after their move
+    resync_depth: int = 8               # plies the board may lag behind the game and still be guided back
+    calibration_samples: int = 15
+    led_refresh_interval: float = 0.0   # min. seconds between repeated identical LED writes
+    move_retries: int = 3               # attempts to send a move to lichess
+    move_retry_delay: float = 3.0
+    low_time_threshold: float = 30.0    # seconds on our clock below which the board goes faster
+    scramble_threshold: float = 10.0    # seconds below which LEDs and logging are cut too
+
+    def replace(self, **changes):
+        return dataclasses.replace(self, **changes)
+
+
+ORIENTATIONS = ('auto', 'normal', 'rotated')
+# range checks, these run before the serial handshake
+POSITIVE = ('baudrate', 'stall_timeout', 'history_depth', 'calibration_samples', 'learned_codes_max',
+            'move_retries')
+NOT_NEGATIVE = ('worker_processes', 'link_stats_interval', 'resync_depth', 'led_refresh_interval',
+                'move_retry_delay', 'low_time_threshold', 'scramble_threshold')
+
+# fields that need a restart of the serial link (or the whole program) to take effect
+STARTUP_ONLY = ('port', 'tokenfile', 'baudrate', 'worker_processes', 'stall_timeout')
+
+PROFILES = {
+    'default': {},
+    'bullet': {
+        'history_depth': 2,
+        'led_refresh_interval': 0.2,
+        'move_retries': 5,
+        'move_retry_delay': 0.5,
+    },
+    'robust': {
+        'history_depth': 5,
+        'fuzzy_matching': True,
+        'calibration_samples': 25,
+    },
+}
+PROFILES['low-latency'] = PROFILES['bullet']
+PROFILES['noisy-board'] = PROFILES['robust']
+
+
+class ConfigError(Exception):
+    pass
+
+
+def read_file(filename):
+    """ parse a TOML or YAML config file into a dict """
+    ext = os.path.splitext(filename)[1].lower()
+    if ext in ('.yaml', '.yml'):
+        try:
+            import yaml
+        except ImportError:
+            raise ConfigError('YAML config files need the pyyaml module')
+        with open(filename) as f:
+            try:
+                data = yaml.safe_load(f) or {}
+            except yaml.YAMLError as e:
+                raise ConfigError(f'{filename}: {e}')
+    else:
+        try:
+            import tomllib
+        except ImportError:
+            try:
+                import tomli as tomllib
+            except ImportError:
+                raise ConfigError('TOML config files need python 3.11 or the tomli module')
+        with open(filename, 'rb') as f:
+            try:
+                data = tomllib.load(f)
+            except tomllib.TOMLDecodeError as e:
+                raise ConfigError(f'{filename}: {e}')
+    if not isinstance(data, dict):
+        raise ConfigError(f'{filename}: expected a mapping at top level')
+    return data
+
+
+def check_values(values, source):
+    types = {f.name: f.type for f in dataclasses.fields(Settings)}
+    checked = {}
+    for key, value in values.items():
+        key = key.replace('-', '_')
+        if key not in types:
+            raise ConfigError(f'{source}: unknown setting {key}')
+        expected = types[key]
+        if expected is float and isinstance(value, int) and not isinstance(value, bool):
+            value = float(value)
+        if type(value) is not expected:
+            raise ConfigError(f'{source}: {key} must be {expected.__name__}')
+        checked[key] = value
+    if checked.get('orientation', 'auto') not in ORIENTATIONS:
+        raise ConfigError(f'{source}: orientation must be one of {", ".join(ORIENTATIONS)}')
+    for key, value in checked.items():
+        if key in POSITIVE and value <= 0:
+            raise ConfigError(f'{source}: {key} must be positive')
+        if key in NOT_NEGATIVE and value < 0:
+            raise ConfigError(f'{source}: {key} must not be negative')
+    return checked
+
+
+def load_settings(filename=None, profile=None, overrides=None):
+    """
+    Build Settings from the defaults, a built-in or file profile and a config file.
+
+    Precedence (lowest first): defaults, built-in profile, top level keys of the
+    file, [profiles.<name>] section of the file, overrides (command line). The
+    profile can also be chosen with a top level "profile" key in the file.
+    """
+    data = read_file(filename) if filename else {}
+    data = dict(data)
+    file_profiles = data.pop('profiles', {}) or {}
+    if not isinstance(file_profiles, dict):
+        raise ConfigError(f'{filename}: profiles must be a table of profiles')
+    for name, section in file_profiles.items():
+        if not isinstance(section, dict):
+            raise ConfigError(f'{filename}: profile {name} must be a table of settings')
+    if profile is None:
+        profile = data.pop('profile', 'default')
+    else:
+        data.pop('profile', None)
+    if not isinstance(profile, str):
+        raise ConfigError(f'{filename}: profile must be a name')
+    if profile not in PROFILES and profile not in file_profiles:
+        raise ConfigError(f'unknown profile {profile}')
+
+    values = {}
+    values.update(check_values(PROFILES.get(profile, {}), f'profile {profile}'))
+    values.update(check_values(data, filename))
+    values.update(check_values(file_profiles.get(profile, {}), f'{filename} profile {profile}'))
+    values.update(check_values(overrides or {}, 'command line'))
+    return Settings(**values), profile
+
+
+class ConfigReloader:
+    """
+    Reload the config file on SIGHUP and hand the new settings to a callback.
+
+    Settings in STARTUP_ONLY keep their current value, a broken config file is
+    logged and the previous settings stay active.
+    """
+
+    def __init__(self, filename, profile, settings, callback, overrides=None):
+        self.filename = filename
+        self.profile = profile
+        self.overrides = overrides
+        self.settings = settings
+        self.callback = callback
+
+    def install(self):
+        if hasattr(signal, 'SIGHUP'):
+            signal.signal(signal.SIGHUP, self.handle_signal)
+
+    def handle_signal(self, signum, frame):
+        self.reload()
+
+    def reload(self):
+        try:
+            settings, profile = load_settings(self.filename, self.profile, self.overrides)
+        except Exception as e:
+            # runs in a signal handler, nothing may escape into the interrupted code
+            logger.info('config reload failed, keeping current settings: %s', e)
+            return self.settings
+        keep = {name: getattr(self.settings, name) for name in STARTUP_ONLY}
+        for name, value in keep.items():
+            if getattr(settings, name) != value:
+                logger.info('config reload: %s needs a restart, keeping %s', name, value)
+        self.settings = settings.replace(**keep)
+        logger.info('config reloaded (profile %s): %s', profile, self.settings)
+        self.callback(self.settings)
+        return self.settings
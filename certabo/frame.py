@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2020 by Harald Klein <hari@vt100.at> - All rights reserved
+#
+
+import random
+import timeit
+
+CELLS = 64
+CODE_LENGTH = 5
+FRAME_LENGTH = CELLS * CODE_LENGTH  # 320
+
+# b'0' .. b'255' -> value, looking a token up converts and range checks it in one step
+TOKEN_VALUES = {str(value).encode('ascii'): value for value in range(256)}
+
+
+def pack_code(cell):
+    """ pack the 5 bytes of an RFID code into one int """
+    return int.from_bytes(bytes(cell), 'big')
+
+
+class BoardFrame():
+    """
+    One reading of the board: 64 cells of 5 code bytes, cell 0 is the top left
+    corner as seen from the connector side.
+
+    The data is a single immutable bytes object, so a frame costs ~350 bytes
+    instead of a list of 320 ints, and can be shared between the history,
+    calibration and decoding without copying. Indexing and iteration yield
+    ints, like the plain lists used before.
+    """
+    __slots__ = ('data',)
+
+    def __init__(self, data):
+        data = bytes(data)
+        if len(data) != FRAME_LENGTH:
+            raise ValueError(f'expected {FRAME_LENGTH} values, got {len(data)}')
+        self.data = data
+
+    def cell(self, n_cell):
+        """ code bytes of one cell """
+        start = n_cell * CODE_LENGTH
+        return self.data[start:start + CODE_LENGTH]
+
+    def code(self, n_cell):
+        """ packed int code of one cell """
+        start = n_cell * CODE_LENGTH
+        return int.from_bytes(self.data[start:start + CODE_LENGTH], 'big')
+
+    def codes(self):
+        return [self.code(n_cell) for n_cell in range(CELLS)]
+
+    def __getitem__(self, i):
+        return self.data[i]
+
+    def __len__(self):
+        return FRAME_LENGTH
+
+    def __iter__(self):
+        return iter(self.data)
+
+    def __eq__(self, other):
+        if isinstance(other, BoardFrame):
+            return self.data == other.data
+        return NotImplemented
+
+    def __hash__(self):
+        return hash(self.data)
+
+    def __repr__(self):
+        return f'BoardFrame({" ".join(map(str, self.data))})'
+
+
+def parse_frame(line):
+    """
+    BoardFrame from one raw line of the board, b':n n n ... n \\r\\n' with
+    FRAME_LENGTH decimal numbers. Works on the bytes as read, without decoding
+    to str. Raises ValueError for a missing ':' prefix, a wrong number of
+    values or a value that isn't a plain decimal byte.
+    """
+    if not line.startswith(b':'):
+        raise ValueError('line does not start with ":"')
+    tokens = line[1:].split()
+    if len(tokens) != FRAME_LENGTH:
+        raise ValueError(f'expected {FRAME_LENGTH} values, got {len(tokens)}')
+    try:
+        return BoardFrame(bytes(map(TOKEN_VALUES.__getitem__, tokens)))
+    except KeyError as e:
+        raise ValueError(f'invalid value {e.args[0]!r}') from None
+
+
+class FrameParser():
+    """
+    parse_frame() for a stream of lines. The board keeps sending the same frame
+    while nothing moves, so a line equal to the previous one reuses its frame.
+    """
+
+    def __init__(self):
+        self.last_line = None
+        self.last_frame = None
+
+    def __call__(self, line):
+        if line == self.last_line:
+            return self.last_frame
+        frame = parse_frame(line)
+        self.last_line = bytes(line)
+        self.last_frame = frame
+        return frame
+
+
+def parse_frame_str(line):
+    """ the previous parser: decode, trim, split and int() every token """
+    message = line.decode("ascii")[1: -3]
+    tokens = message.split(" ")
+    if len(tokens) != FRAME_LENGTH:
+        raise ValueError(f'expected {FRAME_LENGTH} values, got {len(tokens)}')
+    return BoardFrame(map(int, tokens))
+
+
+def benchmark(number=20000):
+    """
+    Microseconds per frame of the previous parser, parse_frame() and a
+    FrameParser seeing the same frame again, on a random frame.
+    """
+    values = [random.randrange(256) for i in range(FRAME_LENGTH)]
+    line = (':' + ' '.join(map(str, values)) + ' \r\n').encode('ascii')
+    parser = FrameParser()
+    assert parse_frame(line) == parse_frame_str(line) == parser(line) == BoardFrame(values)
+    repeated = bytes(bytearray(line))  # equal, but not the same object
+    results = {}
+    for name, function in (('parse_frame_str', lambda: parse_frame_str(line)),
+                           ('parse_frame', lambda: parse_frame(line)),
+                           ('FrameParser, unchanged frame', lambda: parser(repeated))):
+        seconds = min(timeit.repeat(function, number=number, repeat=3))
+        results[name] = seconds / number * 1e6
+    return results
+
+
+if __name__ == '__main__':
+    for name, usec in benchmark().items():
+        print(f'{name}: {usec:.1f} usec per frame')
@@ -0,0 +1,169 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2020 by Harald Klein <hari@vt100.at> - All rights reserved
+#
+
+import os
+import json
+import time
+import queue
+import struct
+import logging
+import threading
+import collections
+
+logger = logging.getLogger(__name__)
+
+# Journal files start with MAGIC, followed by records of
+#   uint32 payload length, uint8 record kind, float64 unix timestamp, payload
+MAGIC = b'CBJ1'
+HEADER = struct.Struct('<IBd')
+
+PLACEMENT = 1   # board_fen() of a decoded frame, ascii
+MOVE = 2        # space separated uci moves, ascii
+LEDS = 3        # the 8 raw LED bytes sent to the board
+EVENT = 4       # lichess stream event, json
+KIND_NAMES = {PLACEMENT: 'placement', MOVE: 'move', LEDS: 'leds', EVENT: 'event'}
+
+Record = collections.namedtuple('Record', ['kind', 'timestamp', 'data'])
+
+
+def encode_record(kind, timestamp, payload: bytes):
+    return HEADER.pack(len(payload), kind, timestamp) + payload
+
+
+def decode_payload(kind, payload):
+    if kind in (PLACEMENT, MOVE):
+        return payload.decode('ascii')
+    if kind == EVENT:
+        return json.loads(payload.decode('utf-8'))
+    return bytes(payload)
+
+
+def read_journal(filename, raw=False):
+    """
+    Lazily iterate over the records of a journal file.
+
+    Yields Record tuples, a truncated record at the end (e.g. after a crash)
+    ends the iteration silently.
+    """
+    with open(filename, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f'{filename} is not a certabo journal')
+        while True:
+            header = f.read(HEADER.size)
+            if len(header) < HEADER.size:
+                return
+            length, kind, timestamp = HEADER.unpack(header)
+            payload = f.read(length)
+            if len(payload) < length:
+                return
+            if raw:
+                yield Record(kind, timestamp, payload)
+            else:
+                yield Record(kind, timestamp, decode_payload(kind, payload))
+
+
+def journal_files(directory):
+    """ all journal files in a directory, oldest first """
+    names = sorted(n for n in os.listdir(directory) if n.endswith('.cbj'))
+    return [os.path.join(directory, n) for n in names]
+
+
+class JournalWriter(threading.Thread):
+    """
+    Append-only session journal written from a background thread.
+
+    The record_*() methods only enqueue, the thread does the encoding, buffered
+    writes, periodic fsync and size based rotation.
+    """
+
+    def __init__(self, directory, max_bytes=16 * 1024 * 1024, fsync_interval=5.0,
+                 maxsize=10000, **kwargs):
+        super().__init__(**kwargs)
+        self.daemon = True
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.fsync_interval = fsync_interval
+        self.session = time.strftime('%Y%m%d-%H%M%S')
+        self.sequence = 0
+        self.queue = queue.Queue(maxsize)
+        self.dropped = 0
+        self.file = None
+        self.filename = None
+        self.written = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def record(self, kind, payload: bytes, timestamp=None):
+        if timestamp is None:
+            timestamp = time.time()
+        try:
+            self.queue.put_nowait((kind, timestamp, payload))
+        except queue.Full:
+            self.dropped += 1
+
+    def record_placement(self, board_fen):
+        self.record(PLACEMENT, board_fen.encode('ascii'))
+
+    def record_moves(self, moves):
+        self.record(MOVE, ' '.join(moves).encode('ascii'))
+
+    def record_leds(self, message: bytes):
+        self.record(LEDS, bytes(message))
+
+    def record_event(self, event, game_id=None):
+        if game_id is not None:
+            event = dict(event, gameId=game_id)
+        self.record(EVENT, json.dumps(event, default=str).encode('utf-8'))
+
+    def close(self, timeout=10.0):
+        # the writer thread may have died (e.g. disk full) with a full queue, never hang shutdown on it
+        if not self.is_alive():
+            return
+        try:
+            self.queue.put(None, timeout=timeout)
+        except queue.Full:
+            logger.info('journal writer not responding, closing without flushing')
+            return
+        self.join(timeout)
+
+    def open_next(self):
+        if self.file is not None:
+            self.sync()
+            self.file.close()
+        self.sequence += 1
+        self.filename = os.path.join(self.directory, f'journal-{self.session}-{self.sequence:03d}.cbj')
+        logger.info('opening journal %s', self.filename)
+        self.file = open(self.filename, 'ab', buffering=64 * 1024)
+        self.file.write(MAGIC)
+        self.written = len(MAGIC)
+
+    def sync(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def run(self):
+        self.open_next()
+        last_sync = time.monotonic()
+        while True:
+            try:
+                item = self.queue.get(timeout=self.fsync_interval)
+            except queue.Empty:
+                item = False
+            if item is None:
+                break
+            if item:
+                kind, timestamp, payload = item
+                data = encode_record(kind, timestamp, payload)
+                if self.written + len(data) > self.max_bytes:
+                    self.open_next()
+                self.file.write(data)
+                self.written += len(data)
+            if time.monotonic() - last_sync >= self.fsync_interval:
+                self.sync()
+                last_sync = time.monotonic()
+        self.sync()
+        self.file.close()
+        if self.dropped:
+            logger.info('journal dropped %d records', self.dropped)
@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2020 by Harald Klein <hari@vt100.at> - All rights reserved
+#
+
+import time
+import pickle
+import logging
+import threading
+import collections
+
+from certabo import codes
+from certabo.frame import pack_code, CODE_LENGTH
+
+logger = logging.getLogger(__name__)
+
+
+class Learner():
+    """
+    Learns RFID codes from confirmed moves on top of a base calibration.
+
+    After a move has been accepted we know which piece stands on the
+    destination square. If its code was unknown or only a near match, it gets
+    added for that piece. Learned codes are kept in LRU order with a usage
+    count, the least recently confirmed ones are evicted beyond max_codes.
+    They live in their own file so the calibration file stays untouched, and
+    are saved from a background thread.
+    """
+
+    def __init__(self, base, filename, max_codes=64, save_delay=5.0):
+        self.base = base
+        self.filename = filename
+        self.max_codes = max_codes
+        self.save_delay = save_delay
+        self.lock = threading.Lock()
+        self.learned = collections.OrderedDict()  # packed code -> [piece name, count]
+        self.save_event = threading.Event()
+        self.saver = threading.Thread(target=self.save_loop, daemon=True)
+        self.load()
+        self.saver.start()
+
+    def load(self):
+        try:
+            with open(self.filename, "rb") as f:
+                for code, name, count in pickle.load(f):
+                    self.learned[code] = [name, count]
+        except (IOError, OSError):
+            return
+        except (ValueError, TypeError, pickle.UnpicklingError):
+            logger.info("Can't load learned codes from %s", self.filename)
+            return
+        logger.info('loaded %d learned codes', len(self.learned))
+
+    def save(self):
+        with self.lock:
+            data = [(code, name, count) for code, (name, count) in self.learned.items()]
+        with open(self.filename, "wb") as f:
+            pickle.dump(data, f)
+        logger.debug('saved %d learned codes', len(data))
+
+    def save_loop(self):
+        while True:
+            self.save_event.wait()
+            # coalesce bursts of learned codes into one write
+            time.sleep(self.save_delay)
+            self.save_event.clear()
+            try:
+                self.save()
+            except OSError as e:
+                logger.info('cannot save learned codes: %s', e)
+
+    def calibration(self):
+        """ new codes.Calibration with the base codes plus all learned ones """
+        pieces = {name: [] for name in codes.PIECES}
+        with self.lock:
+            for code, (name, count) in self.learned.items():
+                pieces[name].append(code.to_bytes(CODE_LENGTH, 'big'))
+        return self.base.merged(codes.Calibration(pieces))
+
+    def set_max_codes(self, max_codes):
+        """ change the limit, returns True if learned codes had to be evicted """
+        with self.lock:
+            self.max_codes = max_codes
+            evicted = self.evict()
+        if evicted:
+            self.save_event.set()
+        return evicted
+
+    def evict(self):
+        # caller holds the lock
+        evicted = False
+        while len(self.learned) > self.max_codes:
+            code, (name, count) = self.learned.popitem(last=False)
+            logger.info('evicting learned code for %s used %d times', name, count)
+            evicted = True
+        return evicted
+
+    def observe(self, name, cell):
+        """
+        The piece name has been confirmed on a square that reads cell. Returns
+        True if the set of learned codes changed.
+        """
+        code = pack_code(cell)
+        known, confidence = self.base.lookup_code(code, False)
+        if known != "":
+            # never override the base calibration
+            return False
+        with self.lock:
+            entry = self.learned.get(code)
+            if entry is not None and entry[0] == name:
+                entry[1] += 1
+                self.learned.move_to_end(code)
+                changed = False
+            else:
+                self.learned[code] = [name, 1]
+                self.learned.move_to_end(code)
+                changed = True
+                logger.info('learned new code %s for %s', list(cell), name)
+                self.evict()
+        self.save_event.set()
+        return changed
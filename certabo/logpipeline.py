@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2020 by Harald Klein <hari@vt100.at> - All rights reserved
+#
+
+import logging
+import logging.handlers
+import queue
+import threading
+
+
+class RateLimitFilter(logging.Filter):
+    """
+    Drop repeated records that share the same logger and message template.
+
+    Records are keyed on the unformatted ``msg``, so "Unknown piece at %s" is one
+    key regardless of the square. Up to ``burst`` records per key pass within
+    ``interval`` seconds, the rest are counted and the count is reported on the
+    next record that gets through. Windows that ran out are dropped once per
+    interval, and at most ``max_keys`` are kept, so one-off messages (e.g.
+    f-strings with a game id) don't pile up in a long running process.
+    """
+
+    def __init__(self, interval=10.0, burst=5, max_keys=1000):
+        super().__init__()
+        self.interval = interval
+        self.burst = burst
+        self.max_keys = max_keys
+        self.lock = threading.Lock()
+        self.windows = {}
+        self.last_prune = 0.0
+
+    def prune(self, now):
+        # caller holds the lock
+        self.last_prune = now
+        for key, (start, count, suppressed) in list(self.windows.items()):
+            if now - start >= self.interval:
+                del self.windows[key]
+        if len(self.windows) >= self.max_keys:
+            self.windows.clear()
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING:
+            return True
+        key = (record.name, record.msg)
+        now = record.created
+        with self.lock:
+            if now - self.last_prune >= self.interval or len(self.windows) >= self.max_keys:
+                self.prune(now)
+            start, count, suppressed = self.windows.get(key, (now, 0, 0))
+            if now - start >= self.interval:
+                start, count = now, 0
+            count += 1
+            if count > self.burst:
+                self.windows[key] = (start, count, suppressed + 1)
+                return False
+            self.windows[key] = (start, count, 0)
+        if suppressed:
+            record.msg = f'{record.msg} ({suppressed} similar messages suppressed)'
+        return True
+
+
+class LazyQueueHandler(logging.handlers.QueueHandler):
+    """
+    QueueHandler that leaves formatting to the listener thread.
+
+    The stock prepare() formats every record in the calling thread, which is
+    exactly the cost we want to keep off the serial and game threads.
+    """
+
+    def prepare(self, record):
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            # never block the caller, losing a log line beats losing a frame
+            pass
+
+
+def parse_levels(specs):
+    """ turn ['certabo.codes=INFO', ...] into {'certabo.codes': logging.INFO} """
+    levels = {}
+    for spec in specs or []:
+        name, _, level = spec.partition('=')
+        if not level:
+            raise ValueError(f'invalid log level spec: {spec}')
+        value = logging.getLevelName(level.strip().upper())
+        if not isinstance(value, int):
+            raise ValueError(f'invalid log level: {level}')
+        levels[name.strip()] = value
+    return levels
+
+
+def setup_logging(filename, console=True, levels=None, asynchronous=True,
+                  rate_limit=True, maxsize=10000):
+    """
+    Configure the root logger with a file handler and an optional console handler.
+
+    With asynchronous=True all records go through a bounded queue and a
+    QueueListener thread does the formatting and I/O. Returns the started
+    listener (or None), call stop() on it to flush on shutdown.
+    """
+    root = logging.getLogger()
+    root.setLevel(logging.DEBUG)
+    formatter = logging.Formatter('%(asctime)s %(levelname)s %(module)s %(message)s')
+
+    handlers = []
+    filehandler = logging.handlers.TimedRotatingFileHandler(filename, backupCount=12)
+    filehandler.setFormatter(formatter)
+    handlers.append(filehandler)
+    if console:
+        consolehandler = logging.StreamHandler()
+        consolehandler.setFormatter(formatter)
+        handlers.append(consolehandler)
+
+    for name, level in (levels or {}).items():
+        logging.getLogger(name).setLevel(level)
+
+    listener = None
+    if asynchronous:
+        entry = LazyQueueHandler(queue.Queue(maxsize))
+        listener = logging.handlers.QueueListener(entry.queue, *handlers, respect_handler_level=True)
+        entry_handlers = [entry]
+    else:
+        entry_handlers = handlers
+
+    for handler in entry_handlers:
+        if rate_limit:
+            handler.addFilter(RateLimitFilter())
+        root.addHandler(handler)
+
+    if listener is not None:
+        listener.start()
+    return listener
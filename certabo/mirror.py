@@ -0,0 +1,211 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2020 by Harald Klein <hari@vt100.at> - All rights reserved
+#
+
+import json
+import time
+import logging
+import threading
+
+import chess
+
+from certabo import codes
+from certabo import serialreader
+
+logger = logging.getLogger(__name__)
+
+LICHESS_URL = 'https://lichess.org'
+MIN_DISPLAY_TIME = 0.5      # seconds a move stays on the LEDs before a newer one replaces it
+REFRESH_INTERVAL = 5.0      # resend the current LEDs, so boards that reconnected catch up
+RECONNECT_DELAY = 5.0
+NO_LEDS = bytes(8)
+
+
+def ignore_frame(frame):
+    pass
+
+
+class LedFanout(threading.Thread):
+    """
+    Sends LED states to any number of boards.
+
+    show() only replaces the pending state, the thread writes it to all boards
+    and then holds it for MIN_DISPLAY_TIME. Moves coming in faster than that
+    are coalesced, the boards skip straight to the latest one.
+    """
+
+    def __init__(self, boards, hold=MIN_DISPLAY_TIME, **kwargs):
+        super().__init__(**kwargs)
+        self.daemon = True
+        self.boards = boards
+        self.hold = hold
+        self.condition = threading.Condition()
+        self.pending = None
+        self.current = NO_LEDS
+        self.coalesced = 0
+
+    def show(self, message):
+        with self.condition:
+            if self.pending is not None:
+                self.coalesced += 1
+            self.pending = bytes(message)
+            self.condition.notify()
+
+    def run(self):
+        while True:
+            with self.condition:
+                if self.pending is None:
+                    self.condition.wait(REFRESH_INTERVAL)
+                if self.pending is not None:
+                    self.current = self.pending
+                    self.pending = None
+                message = self.current
+            for board in self.boards:
+                board.send_led(message)
+            time.sleep(self.hold)
+
+
+class MirrorPosition():
+    """ follows a game from (placement, last move) events, one move at a time """
+
+    def __init__(self):
+        self.board = chess.Board()
+        self.resets = 0
+
+    def reset(self, placement, move=None):
+        self.board = chess.Board(None)
+        self.board.set_board_fen(placement)
+        if move is not None:
+            piece = self.board.piece_at(move.to_square)
+            if piece is not None:
+                self.board.turn = not piece.color
+        self.resets += 1
+
+    def update(self, placement, move=None):
+        """
+        Apply one event, move is the uci move that led to placement or None at
+        the start of a game. Returns the SAN of the move if it followed from the
+        tracked position, None if the position had to be reset.
+        """
+        if move is None:
+            self.reset(placement)
+            return None
+        move = chess.Move.from_uci(move)
+        if self.board.piece_at(move.from_square) is not None:
+            san = self.board.san(move) if self.board.is_legal(move) else move.uci()
+            self.board.push(move)
+            if self.board.board_fen() == placement:
+                return san
+        # missed moves, takeback or a different game: start over from the event
+        logger.debug('mirrored position out of sync, resetting to %s', placement)
+        self.reset(placement, move)
+        return None
+
+
+def stream_lines(session, url):
+    with session.get(url, stream=True, timeout=(10, 60)) as response:
+        response.raise_for_status()
+        for line in response.iter_lines():
+            # empty lines are keepalives
+            if line:
+                yield json.loads(line)
+
+
+def lichess_positions(source, base_url=LICHESS_URL):
+    """
+    (placement, uci move) events of a running lichess game, or of lichess TV
+    if source is 'tv'. These streams are public, no token is needed. The TV
+    feed is reconnected when it breaks, a game stream ends with the game.
+    """
+    import requests
+
+    tv = source == 'tv'
+    url = f'{base_url}/api/tv/feed' if tv else f'{base_url}/api/stream/game/{source}'
+    session = requests.Session()
+    while True:
+        try:
+            for event in stream_lines(session, url):
+                if 't' in event:
+                    # TV feed: 'featured' starts a new game, 'fen' events carry the moves
+                    data = event.get('d', {})
+                    move = data.get('lm') if event['t'] == 'fen' else None
+                else:
+                    data = event
+                    move = event.get('lm') or event.get('lastMove')
+                if 'fen' in data:
+                    yield data['fen'].split(' ')[0], move
+            if not tv:
+                return
+        except (requests.RequestException, ValueError) as e:
+            logger.info('lichess stream %s failed: %s', url, e)
+        time.sleep(RECONNECT_DELAY)
+
+
+def pgn_positions(filename, delay=2.0):
+    """ (placement, uci move) events replaying all games of a PGN file, one move every delay seconds """
+    import chess.pgn
+
+    with open(filename) as f:
+        while True:
+            game = chess.pgn.read_game(f)
+            if game is None:
+                return
+            board = game.board()
+            logger.info('mirroring %s - %s', game.headers.get('White', '?'), game.headers.get('Black', '?'))
+            yield board.board_fen(), None
+            for move in game.mainline_moves():
+                time.sleep(delay)
+                board.push(move)
+                yield board.board_fen(), move.uci()
+            time.sleep(delay)
+
+
+def positions(source, delay=2.0, base_url=LICHESS_URL):
+    if source.lower().endswith('.pgn'):
+        return pgn_positions(source, delay)
+    return lichess_positions(source, base_url)
+
+
+class Mirror():
+    """
+    Read-only spectator mode: shows each new move of a game on the LEDs of
+    one or more boards. The boards only get a serial link, no calibration or
+    move detection.
+    """
+
+    def __init__(self, ports, baudrate=38400, rotate180=False):
+        # LED-only boards can't detect their orientation, it comes from the settings
+        self.rotate180 = rotate180
+        self.boards = []
+        for port in ports:
+            board = serialreader.serialreader(ignore_frame, port, baudrate)
+            board.daemon = True
+            board.start()
+            self.boards.append(board)
+        self.fanout = LedFanout(self.boards)
+        self.fanout.start()
+        self.position = MirrorPosition()
+
+    def wait_ready(self, timeout=None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        for board in self.boards:
+            remaining = None if deadline is None else max(0, deadline - time.monotonic())
+            if not board.ready.wait(remaining):
+                return False
+        return True
+
+    def run(self, events):
+        moves = 0
+        for placement, move in events:
+            san = self.position.update(placement, move)
+            if move is None:
+                logger.info('new game on the mirrored stream')
+                self.fanout.show(NO_LEDS)
+                continue
+            logger.info('mirroring %s', san or move)
+            self.fanout.show(codes.move2ledbytes(move, self.rotate180))
+            moves += 1
+        logger.info('mirrored %d moves, %d resyncs, %d coalesced LED updates',
+                    moves, self.position.resets, self.fanout.coalesced)
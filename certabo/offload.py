@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2020 by Harald Klein <hari@vt100.at> - All rights reserved
+#
+
+import logging
+import threading
+import multiprocessing
+import concurrent.futures
+
+logger = logging.getLogger(__name__)
+
+
+def init_worker():
+    # Workers must never write to the parent's log handlers (or the log
+    # queue), whatever they may have inherited.
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+    root.addHandler(logging.NullHandler())
+
+
+class Job():
+    """
+    Handle for a submitted job. cancel() marks the result as obsolete: a job that
+    hasn't started yet is dropped, a running one finishes but its callback is
+    skipped.
+    """
+
+    def __init__(self):
+        self.future = None
+        self.cancelled = threading.Event()
+
+    def cancel(self):
+        self.cancelled.set()
+        if self.future is not None:
+            self.future.cancel()
+
+    def is_cancelled(self):
+        return self.cancelled.is_set()
+
+
+class Offloader():
+    """
+    Runs CPU heavy jobs in a process pool so they don't hold the GIL on the
+    serial thread. With workers=0 jobs run synchronously in the calling thread.
+
+    Jobs are module level functions with picklable arguments. Workers are not
+    forked from our multithreaded process, where another thread might hold a
+    cache or logging lock at that moment, but started by a forkserver (or
+    spawned where there is none).
+    """
+
+    def __init__(self, workers=0):
+        self.executor = None
+        if workers > 0:
+            if 'forkserver' in multiprocessing.get_all_start_methods():
+                context = multiprocessing.get_context('forkserver')
+            else:
+                context = multiprocessing.get_context()
+            self.executor = concurrent.futures.ProcessPoolExecutor(
+                max_workers=workers,
+                mp_context=context,
+                initializer=init_worker,
+            )
+            logger.info('using %d worker processes', workers)
+
+    @property
+    def parallel(self):
+        return self.executor is not None
+
+    def submit(self, fn, *args, callback=None, errback=None):
+        """
+        Run fn(*args) and pass the result to callback (or the exception to
+        errback) unless the job got cancelled in the meantime. Callbacks of
+        pooled jobs run in the executor's management thread.
+        """
+        job = Job()
+        if self.executor is None:
+            try:
+                result = fn(*args)
+            except Exception as e:
+                if errback is None:
+                    raise
+                errback(e)
+            else:
+                if callback is not None:
+                    callback(result)
+            return job
+
+        def done(future):
+            if job.is_cancelled() or future.cancelled():
+                return
+            try:
+                result = future.result()
+            except Exception as e:
+                if errback is not None:
+                    errback(e)
+                else:
+                    logger.info('offloaded job %s failed: %s', fn.__name__, e)
+                return
+            if callback is not None:
+                callback(result)
+
+        try:
+            job.future = self.executor.submit(fn, *args)
+        except concurrent.futures.BrokenExecutor as e:
+            # a worker died, the pool is unusable from now on
+            logger.info('process pool broken (%s), running jobs inline', e)
+            self.executor = None
+            return self.submit(fn, *args, callback=callback, errback=errback)
+        job.future.add_done_callback(done)
+        return job
+
+    def shutdown(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
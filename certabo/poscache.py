@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2020 by Harald Klein <hari@vt100.at> - All rights reserved
+#
+
+import threading
+import collections
+
+import chess
+
+# every cache created here, for stats()
+caches = []
+
+
+class LRUCache():
+    """ bounded, thread safe memo table with hit/miss counters """
+
+    def __init__(self, name, maxsize=256):
+        self.name = name
+        self.maxsize = maxsize
+        self.data = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        caches.append(self)
+
+    def get(self, key, compute, *args):
+        with self.lock:
+            try:
+                value = self.data[key]
+            except KeyError:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self.data.move_to_end(key)
+                return value
+        # compute outside the lock, a concurrent miss on the same key just computes twice
+        value = compute(*args)
+        with self.lock:
+            self.data[key] = value
+            if len(self.data) > self.maxsize:
+                self.data.popitem(last=False)
+        return value
+
+    def clear(self):
+        with self.lock:
+            self.data.clear()
+
+
+def stats():
+    """ {cache name: (hits, misses, size)} """
+    return {cache.name: (cache.hits, cache.misses, len(cache.data)) for cache in caches}
+
+
+def placement_key(board):
+    """ packed key of the piece placement of a chess.BaseBoard, much cheaper than board_fen() """
+    return (board.pawns, board.knights, board.bishops, board.rooks, board.queens, board.kings,
+            board.occupied_co[chess.WHITE], board.occupied_co[chess.BLACK])
+
+
+def position_key(board):
+    """ placement plus everything that affects the legal moves of a chess.Board """
+    return (placement_key(board), board.turn, board.clean_castling_rights(), board.ep_square)
+
+
+board_fen_cache = LRUCache('board_fen', 64)
+base_board_cache = LRUCache('base_board', 256)
+
+
+def board_fen(board):
+    return board_fen_cache.get(placement_key(board), board.board_fen)
+
+
+def base_board(placement):
+    """ chess.BaseBoard for a placement string, shared between callers - don't modify it """
+    return base_board_cache.get(placement, chess.BaseBoard, placement)
@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+#
+# Copyright (c) 2020 by Harald Klein <hari@vt100.at> - All rights reserved
+#
+
+import collections
+import logging
+
+import chess
+
+logger = logging.getLogger(__name__)
+
+
+class Resync():
+    """
+    Tracks the move list of the running game and remembers the placements of
+    the last `depth` positions.
+
+    If the physical board shows one of those older placements, locate() tells
+    how many plies it is behind with a single dict lookup, and
+    next_placement() gives the position after the next ply to replay, so the
+    squares that change can be lit to catch up.
+    """
+
+    def __init__(self, depth=8, fen=chess.STARTING_FEN):
+        self.depth = depth
+        self.reset(fen)
+
+    def reset(self, fen=chess.STARTING_FEN):
+        self.board = chess.Board(fen)
+        self.moves = []
+        self.placements = {self.board.board_fen(): 0}
+        self.history = collections.deque([self.board.board_fen()])
+
+    def update(self, moves):
+        """
+        Bring the tracked position up to date with the full uci move list of
+        the game. Only new moves are replayed, unless the list doesn't extend
+        the one we know (takeback, new game), then it is rebuilt.
+        """
+        moves = [move for move in moves if move]
+        if moves[:len(self.moves)] != self.moves:
+            self.reset()
+        for move in moves[len(self.moves):]:
+            self.board.push_uci(move)
+            self.moves.append(move)
+            self.remember(self.board.board_fen())
+
+    def remember(self, placement):
+        ply = len(self.moves)
+        self.placements[placement] = ply
+        self.history.append(placement)
+        while len(self.history) > self.depth + 1:
+            old = self.history.popleft()
+            if self.placements.get(old, ply) <= ply - len(self.history):
+                del self.placements[old]
+
+    def locate(self, placement):
+        """ number of plies the given placement is behind the game, None if it isn't a recent position """
+        ply = self.placements.get(placement)
+        if ply is None:
+            return None
+        return len(self.moves) - ply
+
+    def next_placement(self, placement):
+        """
+        Placement one ply after the most recent occurrence of placement, None if
+        it isn't an older recent position. Works on a snapshot of the history,
+        update() may run concurrently on the game thread.
+        """
+        history = list(self.history)
+        for i in range(len(history) - 2, -1, -1):
+            if history[i] == placement:
+                return history[i + 1]
+        return None
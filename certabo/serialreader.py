@@ -7,15 +7,24 @@
 import time
 import os
 import sys
-import argparse
-import subprocess
+import math
+import select
 import threading
-import queue
 import serial
 import fcntl
 import logging
 
-import serial.tools.list_ports
+from certabo.frame import FRAME_LENGTH, FrameParser
+
+logger = logging.getLogger(__name__)
+
+# one frame is ':' + 320 numbers of up to 3 digits and a space + '\r\n', ~1.3 KB
+READ_SIZE = FRAME_LENGTH * 4 + 64
+MIN_READ_SIZE = 256
+STALL_TIMEOUT = 5.0
+DEFAULT_BAUDRATE = 38400
+# lines that may fail to parse after connecting before a non-default baudrate is given up
+MAX_UNVERIFIED_LINES = 10
 
 if os.name == 'nt':  # sys.platform == 'win32':
     from serial.tools.list_ports_windows import comports
@@ -23,83 +32,237 @@ elif os.name == 'posix':
     from serial.tools.list_ports_posix import comports
 
 def find_port():
-    logging.debug('Searching for port...')
+    logger.debug('Searching for port...')
     for port in comports():
         device = port[0]
         if 'bluetooth' in device.lower():
             continue
         if port.pid != 0xea60 and port.vid != 0x10c4:
-            logging.debug(f'skipping: {port.hwid}')
+            logger.debug('skipping: %s', port.hwid)
             continue
         try:
-            logging.debug('Trying %s', device)
+            logger.debug('Trying %s', device)
             s = serial.Serial(device)
         except serial.SerialException:
-            logging.debug('Port is busy, continuing...')
+            logger.debug('Port is busy, continuing...')
             continue
         else:
             s.close()
-            logging.debug('Port is found! - %s', device)
+            logger.debug('Port is found! - %s', device)
             if (sys.version_info.major == 2):
                 if isinstance(device, unicode):
                     device = device.encode('utf-8')
             return device
     else:
-        logging.debug('Port not found')
+        logger.debug('Port not found')
         return
 
+
+class SerialStall(IOError):
+    """ the board didn't send anything within the stall timeout """
+    pass
+
+
+class LinkStats():
+    """
+    Measures the serial link over a fixed interval: frames per second, bytes
+    per frame, jitter (standard deviation of the time between frames), the
+    share of lines that didn't parse into a frame and the line utilization.
+    """
+
+    def __init__(self, interval=10.0):
+        self.interval = interval
+        self.reset(time.monotonic())
+
+    def reset(self, now):
+        self.start = now
+        self.frames = 0
+        self.errors = 0
+        self.bytes = 0
+        self.last_frame = None
+        self.gaps = 0
+        self.gap_sum = 0.0
+        self.gap_squares = 0.0
+
+    def line(self, length, ok, now):
+        self.bytes += length
+        if not ok:
+            self.errors += 1
+            return
+        self.frames += 1
+        if self.last_frame is not None:
+            gap = now - self.last_frame
+            self.gaps += 1
+            self.gap_sum += gap
+            self.gap_squares += gap * gap
+        self.last_frame = now
+
+    def due(self, now):
+        return now - self.start >= self.interval
+
+    def bytes_per_frame(self):
+        return self.bytes / self.frames if self.frames else None
+
+    def summary(self, now, baudrate):
+        elapsed = max(now - self.start, 1e-6)
+        lines = self.frames + self.errors
+        jitter = 0.0
+        if self.gaps > 1:
+            mean = self.gap_sum / self.gaps
+            jitter = math.sqrt(max(0.0, self.gap_squares / self.gaps - mean * mean))
+        return {
+            'fps': self.frames / elapsed,
+            'bytes_per_frame': self.bytes_per_frame() or 0.0,
+            'jitter': jitter,
+            'error_rate': self.errors / lines if lines else 0.0,
+            # 10 bits per byte on the wire with start and stop bit
+            'utilization': self.bytes * 10 / (baudrate * elapsed),
+        }
+
+
 class serialreader(threading.Thread):
-    def __init__ (self, handler, device='auto'):
+    def __init__ (self, handler, device='auto', baudrate=38400, stall_timeout=STALL_TIMEOUT, stall_handler=None,
+                  stats_interval=0.0):
         threading.Thread.__init__(self)
         self.device = device
+        self.baudrate = baudrate
+        # a baudrate other than the default is only kept once a frame has been read with it
+        self.verified = baudrate == DEFAULT_BAUDRATE
+        self.stall_timeout = stall_timeout
         self.connected = False
+        self.ready = threading.Event()
+        # set while the board is silent, stall_handler(True/False) is called on changes
+        self.stalled = threading.Event()
+        self.stall_handler = stall_handler
         self.handler = handler
         self.uart = None
+        self.poller = None
         self.buf = bytearray()
+        self.scanned = 0
+        self.read_size = READ_SIZE
+        self.parse_frame = FrameParser()
+        self.stats = LinkStats()
+        self.set_stats_interval(stats_interval)
+
+    def set_stats_interval(self, interval):
+        """ log link statistics every interval seconds, 0 only measures them to size the reads """
+        self.log_stats = interval > 0
+        self.stats.interval = interval if interval > 0 else 10.0
 
     def send_led(self, message: bytes):
-        # logging.debug(f'Sending to serial: {message}')
+        # logger.debug(f'Sending to serial: {message}')
         if self.connected:
             return self.uart.write(message)
         return None
 
+    def read_chunk(self):
+        """
+        Whatever the board has sent, up to READ_SIZE bytes. Waits at most
+        stall_timeout for data and returns b'' if nothing arrived.
+        """
+        if self.poller is not None:
+            events = self.poller.poll(self.stall_timeout * 1000)
+            if not events:
+                return b''
+            for fd, event in events:
+                if event & (select.POLLERR | select.POLLHUP | select.POLLNVAL):
+                    raise serial.SerialException('serial device disconnected')
+            data = os.read(self.uart.fileno(), self.read_size)
+            if not data:
+                raise serial.SerialException('serial device disconnected')
+            return data
+        # no poll() for serial ports on windows, the port's read timeout does the waiting
+        return self.uart.read(max(1, min(self.read_size, self.uart.in_waiting)))
+
     def readline(self):
-        i = self.buf.find(b"\n")
-        if i >= 0:
-            r = self.buf[:i+1]
-            self.buf = self.buf[i+1:]
-            return r
         while True:
-            i = max(1, min(2048, self.uart.in_waiting))
-            data = self.uart.read(i)
-            i = data.find(b"\n")
+            # only scan the bytes that haven't been searched yet
+            i = self.buf.find(b"\n", self.scanned)
             if i >= 0:
-                r = self.buf + data[:i+1]
-                self.buf[0:] = data[i+1:]
+                r = bytes(self.buf[:i+1])
+                del self.buf[:i+1]
+                self.scanned = 0
                 return r
-            else:
-                self.buf.extend(data)
+            self.scanned = len(self.buf)
+            data = self.read_chunk()
+            if not data:
+                raise SerialStall(f'no data for {self.stall_timeout}s')
+            self.buf.extend(data)
+
+    def set_stalled(self, stalled):
+        if stalled == self.stalled.is_set():
+            return
+        if stalled:
+            logger.info('board stopped sending for %.1fs', self.stall_timeout)
+            self.stalled.set()
+        else:
+            logger.info('board is sending again')
+            self.stalled.clear()
+        if self.stall_handler is not None:
+            self.stall_handler(stalled)
+
+    def update_stats(self, length, ok):
+        now = time.monotonic()
+        self.stats.line(length, ok, now)
+        if not self.stats.due(now):
+            return
+        bytes_per_frame = self.stats.bytes_per_frame()
+        if bytes_per_frame is not None:
+            # one read per frame, with some room for frames with longer numbers
+            self.read_size = max(MIN_READ_SIZE, int(bytes_per_frame * 1.1) + 16)
+        if self.log_stats:
+            logger.info('serial link at %d baud: %.2f frames/s, %.0f bytes/frame, jitter %.1fms, '
+                        '%.1f%% parse errors, %.0f%% utilization, read size %d',
+                        self.baudrate, *self.link_summary(now), self.read_size)
+        self.stats.reset(now)
+
+    def link_summary(self, now):
+        summary = self.stats.summary(now, self.baudrate)
+        return (summary['fps'], summary['bytes_per_frame'], summary['jitter'] * 1000,
+                summary['error_rate'] * 100, summary['utilization'] * 100)
+
+    def fall_back(self, reason):
+        """ give up a baudrate the board doesn't talk, returns True if there was one """
+        if self.verified:
+            return False
+        logger.info('%s at %d baud, falling back to %d baud', reason, self.baudrate, DEFAULT_BAUDRATE)
+        self.baudrate = DEFAULT_BAUDRATE
+        self.verified = True
+        return True
+
+    def disconnect(self):
+        self.connected = False
+        self.ready.clear()
+        self.poller = None
+        self.buf.clear()
+        self.scanned = 0
+        if self.uart is not None:
+            try:
+                self.uart.close()
+            except Exception:
+                pass
 
     def run(self):
         while True:
             if not self.connected:
                 try:
                     if self.device == 'auto':
-                        logging.info(f'Auto-detecting serial port')
+                        logger.info('Auto-detecting serial port')
                         serialport = find_port()
                     else:
                         serialport = self.device
                     if serialport is None:
-                        logging.info(f'No port found, retrying')
+                        logger.info('No port found, retrying')
                         time.sleep(1)
                         continue
-                    logging.info(f'Opening serial port {serialport}')
-                    self.uart = serial.Serial(serialport, 38400)  # 0-COM1, 1-COM2 / speed /
-                    # self.uart = serial.Serial(serialport, 38400, timeout=2.5)  # 0-COM1, 1-COM2 / speed /
+                    logger.info('Opening serial port %s', serialport)
+                    self.uart = serial.Serial(serialport, self.baudrate, timeout=self.stall_timeout)  # 0-COM1, 1-COM2 / speed /
                     if os.name == 'posix':
-                        logging.debug(f'Attempting to lock {serialport}')
+                        logger.debug('Attempting to lock %s', serialport)
                         fcntl.flock(self.uart.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
-                    logging.debug(f'Flushing input on {serialport}')
+                        self.poller = select.poll()
+                        self.poller.register(self.uart.fileno(), select.POLLIN)
+                    logger.debug('Flushing input on %s', serialport)
                     self.uart.flushInput()
                     self.uart.write(b'U\xaaU\xaaU\xaaU\xaa')
                     time.sleep(1)
@@ -107,26 +270,54 @@ class serialreader(threading.Thread):
                     time.sleep(1)
                     self.uart.write(b'\x00\x00\x00\x00\x00\x00\x00\x00')
                     self.connected = True
+                    self.ready.set()
                 except Exception as e:
-                    logging.info(f'ERROR: Cannot open serial port {serialport}: {str(e)}')
-                    self.connected = False
+                    logger.info('ERROR: Cannot open serial port %s: %s', serialport, e)
+                    if isinstance(e, ValueError):
+                        # pyserial rejects baudrates the port doesn't support with a ValueError
+                        self.fall_back('cannot open the port')
+                    self.disconnect()
                     time.sleep(0.1)
             else:
+                stalls = 0
+                unverified_lines = 0
+                self.stats.reset(time.monotonic())
                 try:
                     while True:
-                        # logging.debug(f'serial data pending')
-                        #raw_message = self.uart.readline()
-                        raw_message = self.readline()
                         try:
-                            message = raw_message.decode("ascii")[1: -3]
-                            #if DEBUG:
-                            #    print(len(message.split(" ")), "numbers")
-                            if len(message.split(" ")) == 320:  # 64*5
-                                self.handler(message)
-                            message = ""
+                            raw_message = self.readline()
+                        except SerialStall:
+                            if self.fall_back('no data from the board'):
+                                raise
+                            self.set_stalled(True)
+                            stalls += 1
+                            if stalls >= 3:
+                                # a silent link doesn't recover by itself, start over with the handshake
+                                raise
+                            continue
+                        stalls = 0
+                        self.set_stalled(False)
+                        try:
+                            frame = self.parse_frame(raw_message)
+                        except ValueError as e:
+                            # partial lines after connecting are normal, only log them when debugging
+                            logger.debug('cannot parse line from board: %s', e)
+                            frame = None
+                        self.update_stats(len(raw_message), frame is not None)
+                        if frame is None:
+                            if not self.verified:
+                                unverified_lines += 1
+                                if unverified_lines >= MAX_UNVERIFIED_LINES and self.fall_back('no valid frames'):
+                                    raise serial.SerialException('reconnecting at the default baudrate')
+                            continue
+                        if not self.verified:
+                            logger.info('receiving frames at %d baud', self.baudrate)
+                            self.verified = True
+                        try:
+                            self.handler(frame)
                         except Exception as e:
-                            logging.info(f'Exception during message decode: {str(e)}')
+                            logger.info('Exception during message decode: %s', e)
                 except Exception as e:
-                    logging.info(f'Exception during serial communication: {str(e)}')
-                    self.connected = False
+                    logger.info('Exception during serial communication: %s', e)
+                    self.disconnect()
 